@@ -1,5 +1,7 @@
 from flask import Flask
-from flask_jwt_extended import JWTManager
+from flask_jwt_extended import JWTManager, verify_jwt_in_request, get_jwt, get_jwt_identity
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError, ExpiredSignatureError
 
 from app.utils.database import db
 from .models.revoked_tokens import RevokedToken
@@ -8,14 +10,20 @@ from .models.user import User
 from .routes.api.metasploit import metasploit
 from .routes.api.nmap import nmap
 from .routes.api.zap import zap
-from .utils.connection_pool import ConnectionPool
+from .utils.connection_pool import pool
 
 from .utils.mail import mail
+from .utils.scan_jobs import scan_jobs
+from .utils.scan_cache import scan_cache
+from .utils.revocation_cache import revocation_cache
+from .utils.passwords import passwords
+from .utils.identity import load_identity, reject_identity
 
 from .routes.api.auth import auth
 from .routes.api.missions import missions
 from .routes.api.users import users
 from .routes.api.pocs import pocs
+from .routes.api.nodes import nodes
 
 
 
@@ -35,6 +43,11 @@ else:
 # Initializations
 db.init_app(app)
 mail.init_app(app)
+scan_jobs.init_app(app)
+scan_cache.init_app(app)
+pool.init_app(app)
+revocation_cache.init_app(app)
+passwords.init_app(app)
 jwt = JWTManager(app)
 
 
@@ -45,6 +58,7 @@ app.register_blueprint(auth, url_prefix='/api/auth')
 app.register_blueprint(users, url_prefix='/api/users')
 app.register_blueprint(missions, url_prefix='/api/missions')
 app.register_blueprint(pocs, url_prefix='/api/pocs')
+app.register_blueprint(nodes, url_prefix='/api/nodes')
 #Tools routes
 app.register_blueprint(nmap, url_prefix='/api/nmap')
 app.register_blueprint(metasploit, url_prefix='/api/metasploit')
@@ -54,21 +68,38 @@ app.register_blueprint(zap, url_prefix='/api/zap')
 
 
 ###### Middleware #######
-'''
 @app.before_request
-@jwt_required(optional=True)  # Use optional=True to allow non-authenticated routes
 def check_revoked_token():
     """
     This middleware function will run befor execution any endpoint route to make sure the token is not revoked before
-    :return: None if token not revoked ELSE 401 if token revoked or 500 error
+    (answered from the in memory revocation cache, no database access for tokens that are not revoked)
+    then stores the identity of the request, the only place where the token is decoded (see utils/identity).
+    A token that is not accepted (expired, malformed, revoked) never blocks the request here: public endpoints
+    (login, register ...) still work with a stale token, endpoints requiring an identity answer with the error
+    :return: None
     """
+    load_identity(None, None)
     try:
-        jwt_data = get_jwt()
-        jti = jwt_data["jti"]
-        if RevokedToken.is_token_revoked(jti):
-            return jsonify({"message": "Token revoked"}), 401
-        return None  # Continue with the request
+        # optional: non-authenticated routes
+        verify_jwt_in_request(optional=True)
+    except ExpiredSignatureError:
+        reject_identity("Token has expired")
+        return None
+    except (JWTExtendedException, PyJWTError) as e:
+        reject_identity(f"Invalid token: {e}", 422)
+        return None
+
+    claims = get_jwt()
+    jti = claims.get("jti")
+    if not jti:
+        # non-authenticated request
+        return None
+    try:
+        if revocation_cache.is_revoked(jti):
+            reject_identity("Token revoked")
+            return None
+        load_identity(get_jwt_identity(), claims)
     except Exception as e:
-        return jsonify({"message": "An error occurred"}), 500
-
-'''
\ No newline at end of file
+        print(f'Unable to check the revoked tokens: {e}')
+        reject_identity("An error occurred", 500)
+    return None  # Continue with the request
@@ -0,0 +1,86 @@
+import uuid
+from datetime import datetime
+from enum import Enum
+
+from app.utils.database import db
+
+
+class Status(Enum):
+    ONGOING = "ongoing"
+    COMPLETED = "completed"
+
+
+class ListedDatabase(db.EmbeddedDocument):
+    database = db.StringField(required=True)
+    tables = db.ListField(db.StringField())
+
+
+class DumpedTable(db.EmbeddedDocument):
+    database = db.StringField(required=True)
+    table = db.StringField(required=True)
+    rows = db.ListField(db.DictField())
+    dumped_at = db.DateTimeField(default=datetime.utcnow)
+
+
+class DumpCheckpoint(db.Document):
+    """
+    Progress of a sqlmap dump of a mission target, saved after every step so that an interrupted dump
+    resumes where it stopped
+    """
+    checkpoint_id = db.StringField(required=True, default=lambda: str(uuid.uuid4()))
+    mission_id = db.StringField(required=True)
+    target = db.StringField(required=True)
+    status = db.EnumField(Status, default=Status.ONGOING)
+    dbms_type = db.StringField()
+    # None until the databases of the target are listed
+    databases = db.ListField(db.StringField(), default=None)
+    listed = db.ListField(db.EmbeddedDocumentField(ListedDatabase))
+    dumped = db.ListField(db.EmbeddedDocumentField(DumpedTable))
+    # sqlmap session/output directory on the nodes, reused so the injection point is not detected again
+    output_dir = db.StringField()
+    started_at = db.DateTimeField(default=datetime.utcnow)
+    updated_at = db.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'collection': 'dump_checkpoints',
+        'indexes': [
+            ('mission_id', 'target', 'status')
+        ]
+    }
+
+    @classmethod
+    def resume_or_start(cls, mission_id, target, output_root):
+        """
+        :param mission_id:
+        :param target:
+        :param output_root: directory under which sqlmap sessions are kept on the nodes
+        :return: the unfinished checkpoint of the target OR a new one
+        """
+        checkpoint = cls.objects(mission_id=mission_id, target=target, status=Status.ONGOING) \
+            .order_by('-started_at').first()
+        if checkpoint:
+            return checkpoint
+
+        checkpoint = cls(mission_id=mission_id, target=target)
+        checkpoint.output_dir = f"{output_root.rstrip('/')}/{checkpoint.checkpoint_id}"
+        checkpoint.save()
+        return checkpoint
+
+    def save_databases(self, dbms_type, databases):
+        self.update(set__dbms_type=dbms_type, set__databases=databases, set__updated_at=datetime.utcnow())
+        self.dbms_type = dbms_type
+        self.databases = databases
+
+    def save_tables(self, database, tables):
+        listed = ListedDatabase(database=database, tables=tables)
+        self.update(push__listed=listed, set__updated_at=datetime.utcnow())
+        self.listed.append(listed)
+
+    def save_table_dump(self, database, table, rows):
+        dumped = DumpedTable(database=database, table=table, rows=rows)
+        self.update(push__dumped=dumped, set__updated_at=datetime.utcnow())
+        self.dumped.append(dumped)
+
+    def complete(self):
+        self.update(set__status=Status.COMPLETED, set__updated_at=datetime.utcnow())
+        self.status = Status.COMPLETED
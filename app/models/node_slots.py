@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+from mongoengine import NotUniqueError
+
+from app.utils.database import db
+
+
+class NodeSlot(db.Document):
+    """
+    One of the max_conns command slots of a pool node, shared by every worker process:
+    a slot is held by a worker until expires_at, workers keep their slots alive with heartbeats
+    so that the slots of a crashed worker are freed after the lease ttl
+    """
+    hostname = db.StringField(required=True)
+    slot = db.IntField(required=True)
+    owner = db.StringField()
+    expires_at = db.DateTimeField(required=True)
+
+    meta = {
+        'collection': 'node_slots',
+        'indexes': [
+            {'fields': ['hostname', 'slot'], 'unique': True},
+            'owner',
+            # slots of removed nodes are cleaned up by mongodb
+            {'fields': ['expires_at'], 'expireAfterSeconds': 86400},
+        ]
+    }
+
+    @classmethod
+    def claim(cls, hostname, max_conns, owner, ttl):
+        """
+        Takes a free (expired) slot of a node
+        :param hostname:
+        :param max_conns: number of slots of the node
+        :param owner: id of the worker process
+        :param ttl: seconds the slot is held without heartbeat
+        :return: the slot OR None if every slot of the node is held
+        """
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=ttl)
+
+        slot = cls.objects(hostname=hostname, slot__lt=max_conns, expires_at__lte=now).modify(
+            set__owner=owner, set__expires_at=expires_at, new=True)
+        if slot:
+            return slot
+
+        taken = set(cls.objects(hostname=hostname).distinct('slot'))
+        for number in range(max_conns):
+            if number in taken:
+                continue
+            try:
+                return cls(hostname=hostname, slot=number, owner=owner, expires_at=expires_at).save(force_insert=True)
+            except NotUniqueError:
+                # taken by another worker meanwhile
+                continue
+        return None
+
+    @classmethod
+    def free(cls, slot_id, owner):
+        cls.objects(id=slot_id, owner=owner).update_one(set__owner=None, set__expires_at=datetime.utcnow())
+
+    @classmethod
+    def heartbeat(cls, slot_ids, owner, ttl):
+        """
+        Extends the slots held by a worker
+        :return: number of slots extended (fewer than slot_ids when some expired and were taken over)
+        """
+        if not slot_ids:
+            return 0
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+        return cls.objects(id__in=list(slot_ids), owner=owner).update(set__expires_at=expires_at)
+
+    @classmethod
+    def get_held_counts(cls):
+        """
+        :return: hostname -> number of slots held by all the workers
+        """
+        held = cls.objects(expires_at__gt=datetime.utcnow()).aggregate([
+            {'$group': {'_id': '$hostname', 'count': {'$sum': 1}}}
+        ])
+        return {entry['_id']: entry['count'] for entry in held}
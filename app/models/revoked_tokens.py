@@ -1,3 +1,6 @@
+from datetime import datetime, timedelta
+
+from bson import ObjectId
 from mongoengine import NotUniqueError, DoesNotExist
 from werkzeug.exceptions import BadRequest
 
@@ -17,6 +20,13 @@ class RevokedToken(db.Document):
     issued_at = db.DateTimeField(required=True)
     category = db.EnumField(Category, default=Category.USER_TOKEN)
 
+    meta = {
+        # documents are removed by mongodb once the token is expired (a revoked token is useless after its expiry)
+        'indexes': [
+            {'fields': ['expired_at'], 'expireAfterSeconds': 0}
+        ]
+    }
+
     #### Methods ####
     @classmethod
     def revoke_token(cls, jti, issued_at, expired_at, category=None):
@@ -29,3 +39,36 @@ class RevokedToken(db.Document):
     @classmethod
     def is_token_revoked(cls, jti):
         return cls.objects(jti=jti).first() is not None
+
+    @classmethod
+    def purge_expired(cls):
+        """
+        Deletes the expired tokens right away (the TTL monitor of mongodb runs every minute)
+        :return: number of deleted tokens
+        """
+        return cls.objects(expired_at__lte=datetime.utcnow()).delete()
+
+    @classmethod
+    def get_revoked_token(cls, jti):
+        return cls.objects(jti=jti).only('jti', 'expired_at').first()
+
+    @classmethod
+    def get_live_tokens(cls):
+        """
+        :return: tokens revoked and not expired yet
+        """
+        return cls.objects(expired_at__gt=datetime.utcnow()).only('id', 'jti', 'expired_at')
+
+    @classmethod
+    def get_revoked_since(cls, last_id, overlap=timedelta(seconds=30)):
+        """
+        Tokens revoked after the document last_id, ids of documents inserted at the same time by several
+        processes are not ordered so the last 'overlap' before last_id is read again
+        :param last_id: ObjectId of the last document read (None: all the live tokens)
+        :param overlap:
+        :return: live tokens ordered by id
+        """
+        tokens = cls.get_live_tokens()
+        if last_id is not None:
+            tokens = tokens.filter(id__gt=ObjectId.from_datetime(last_id.generation_time - overlap))
+        return tokens.order_by('id')
@@ -0,0 +1,37 @@
+from datetime import datetime
+
+from app.utils.database import db
+
+
+class ScanCacheEntry(db.Document):
+    key = db.StringField(required=True, unique=True)
+    scan_type = db.StringField()
+    results = db.ListField(db.DictField())
+    cached_at = db.DateTimeField(default=datetime.utcnow)
+    expires_at = db.DateTimeField(required=True)
+
+    meta = {
+        'collection': 'scan_cache',
+        # documents are removed by mongodb once expired
+        'indexes': [
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+    @classmethod
+    def get_entry(cls, key):
+        return cls.objects(key=key, expires_at__gt=datetime.utcnow()).first()
+
+    @classmethod
+    def save_entry(cls, key, scan_type, results, expires_at):
+        cls.objects(key=key).update_one(
+            set__scan_type=scan_type,
+            set__results=results,
+            set__cached_at=datetime.utcnow(),
+            set__expires_at=expires_at,
+            upsert=True
+        )
+
+    @classmethod
+    def delete_entry(cls, key):
+        cls.objects(key=key).delete()
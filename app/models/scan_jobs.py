@@ -0,0 +1,164 @@
+from datetime import datetime
+
+from app.utils.database import db
+
+
+class ScanJobRecord(db.Document):
+    """
+    State of a background scan job, shared by every worker process:
+    any worker answers the status, results and cancel requests of a job run by another one
+    """
+    job_id = db.StringField(required=True, unique=True)
+    name = db.StringField()
+    # public_id of the user who submitted the job
+    owner = db.StringField(required=True)
+    # worker process running the job
+    worker = db.StringField()
+    status = db.StringField(default='queued')
+    error = db.StringField()
+    results_count = db.IntField(default=0)
+    cancel_requested = db.BooleanField(default=False)
+    created_at = db.DateTimeField(default=datetime.utcnow)
+    started_at = db.DateTimeField()
+    # refreshed by the worker while the job is queued or running
+    heartbeat_at = db.DateTimeField(default=datetime.utcnow)
+    finished_at = db.DateTimeField()
+    # set once the job is finished, the job is then removed by mongodb
+    expires_at = db.DateTimeField()
+
+    meta = {
+        'collection': 'scan_jobs',
+        'indexes': [
+            'owner',
+            ('status', 'heartbeat_at'),
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+    @property
+    def done(self):
+        return self.status in ('completed', 'failed', 'cancelled')
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'name': self.name,
+            'status': self.status,
+            'results_count': self.results_count,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    @classmethod
+    def create_job(cls, job_id, name, owner, worker):
+        return cls(job_id=job_id, name=name, owner=owner, worker=worker).save(force_insert=True)
+
+    @classmethod
+    def get_job(cls, job_id, owner):
+        """
+        :return: the job OR None if it does not exist or belongs to another user
+        """
+        return cls.objects(job_id=job_id, owner=owner).first()
+
+    @classmethod
+    def start_job(cls, job_id):
+        """
+        :return: True if the job was still queued (not cancelled meanwhile)
+        """
+        now = datetime.utcnow()
+        return bool(cls.objects(job_id=job_id, status='queued').update_one(
+            set__status='running', set__started_at=now, set__heartbeat_at=now))
+
+    @classmethod
+    def add_result(cls, job_id, result):
+        """
+        Stores the next result of a running job
+        :return: True if the job was asked to stop (cancel from any worker)
+        """
+        job = cls.objects(job_id=job_id).modify(inc__results_count=1, set__heartbeat_at=datetime.utcnow(), new=False)
+        if job is None:
+            return True
+        ScanJobResult(job_id=job_id, index=job.results_count, result=result).save(force_insert=True)
+        return job.cancel_requested
+
+    @classmethod
+    def finish_job(cls, job_id, status, error, retention):
+        now = datetime.utcnow()
+        cls.objects(job_id=job_id).update_one(
+            set__status=status, set__error=error, set__finished_at=now, set__expires_at=now + retention)
+        ScanJobResult.objects(job_id=job_id).update(set__expires_at=now + retention)
+
+    @classmethod
+    def beat(cls, job_ids):
+        """
+        Refreshes the heartbeat of the jobs of a worker
+        :param job_ids: jobs queued or running in the worker
+        :return:
+        """
+        cls.objects(job_id__in=job_ids, status__in=['queued', 'running']).update(set__heartbeat_at=datetime.utcnow())
+
+    @classmethod
+    def fail_stale_jobs(cls, stale_after, retention, job_id=None):
+        """
+        Marks failed the queued or running jobs whose worker stopped (no heartbeat for stale_after)
+        :param stale_after: timedelta
+        :param retention: time the failed jobs are kept
+        :param job_id: only this job (checked on poll) OR all the jobs
+        :return: number of failed jobs
+        """
+        now = datetime.utcnow()
+        stale = cls.objects(status__in=['queued', 'running'], heartbeat_at__lt=now - stale_after)
+        if job_id:
+            stale = stale.filter(job_id=job_id)
+
+        count = 0
+        for job in stale.only('job_id'):
+            # conditional update, the job may have been finished meanwhile
+            if cls.objects(job_id=job.job_id, status__in=['queued', 'running'],
+                           heartbeat_at__lt=now - stale_after).update_one(
+                    set__status='failed', set__error='The worker running the job stopped',
+                    set__finished_at=now, set__expires_at=now + retention):
+                ScanJobResult.objects(job_id=job.job_id).update(set__expires_at=now + retention)
+                count += 1
+        return count
+
+    @classmethod
+    def cancel_job(cls, job_id, owner, retention):
+        """
+        Cancels a queued job right away, a running job is asked to stop
+        :return: the job OR None if it does not exist or belongs to another user
+        """
+        now = datetime.utcnow()
+        job = cls.objects(job_id=job_id, owner=owner, status='queued').modify(
+            set__status='cancelled', set__finished_at=now, set__expires_at=now + retention, new=True)
+        if job:
+            return job
+        return cls.objects(job_id=job_id, owner=owner).modify(set__cancel_requested=True, new=True)
+
+
+class ScanJobResult(db.Document):
+    """
+    One result (host) of a scan job
+    """
+    job_id = db.StringField(required=True)
+    index = db.IntField(required=True)
+    result = db.DictField()
+    expires_at = db.DateTimeField()
+
+    meta = {
+        'collection': 'scan_job_results',
+        'indexes': [
+            {'fields': ['job_id', 'index'], 'unique': True},
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+    @classmethod
+    def get_results(cls, job_id, offset=0):
+        """
+        :param offset: number of results already received
+        :return: results of the job from offset, in order
+        """
+        return [entry.result for entry in cls.objects(job_id=job_id, index__gte=offset).order_by('index')]
@@ -0,0 +1,102 @@
+import uuid
+from datetime import datetime
+
+from app.utils.database import db
+
+
+class ScannedHost(db.Document):
+    """
+    One host of a scan, stored apart from the scan: a scan of a large network would not fit
+    in a single document (16 MB), and hosts are written as soon as they are scanned
+    """
+    scan_id = db.StringField(required=True)
+    host = db.StringField(required=True)
+    status = db.StringField()
+    scanned_at = db.DateTimeField(default=datetime.utcnow)
+    result = db.DictField()
+
+    meta = {
+        'collection': 'scanned_hosts',
+        'indexes': [
+            ('scan_id', 'host'),
+            ('scan_id', 'status')
+        ]
+    }
+
+
+class Scan(db.Document):
+    scan_id = db.StringField(required=True, default=lambda: str(uuid.uuid4()))
+    mission_id = db.StringField(required=True)
+    tool = db.StringField(default='nmap')
+    # normalized targets and canonical arguments, recurring scans of a mission share them
+    targets = db.StringField()
+    arguments = db.StringField()
+    created_at = db.DateTimeField(default=datetime.utcnow)
+    # 'running' while the hosts are written, only completed scans are used as reference
+    status = db.StringField(default='running')
+    hosts_count = db.IntField(default=0)
+
+    meta = {
+        'collection': 'scans',
+        'indexes': [
+            ('mission_id', 'targets', 'arguments', '-created_at')
+        ]
+    }
+
+    @classmethod
+    def get_last_scan(cls, mission_id, targets, arguments, tool='nmap'):
+        """
+        :return: last completed scan of the mission with these targets and arguments OR None
+        """
+        return cls.objects(mission_id=mission_id, tool=tool, targets=targets, arguments=arguments,
+                           status='completed').order_by('-created_at').first()
+
+    @classmethod
+    def start_scan(cls, mission_id, targets, arguments, tool='nmap'):
+        """
+
+        :param mission_id:
+        :param targets: normalized targets
+        :param arguments: canonical arguments
+        :param tool:
+        :return: the new scan, hosts are added with add_host
+        """
+        return cls(mission_id=mission_id, tool=tool, targets=targets, arguments=arguments).save(force_insert=True)
+
+    def add_host(self, result, scanned_at):
+        """
+        Stores a host of the scan
+        :param result: host information dictionary
+        :param scanned_at: scan date of the host
+        :return:
+        """
+        ScannedHost(scan_id=self.scan_id, host=result['Host'], status=result['Status'], scanned_at=scanned_at,
+                    result=result).save(force_insert=True)
+        self.hosts_count += 1
+
+    def complete(self):
+        self.update(set__status='completed', set__hosts_count=self.hosts_count)
+        self.status = 'completed'
+
+    def discard(self):
+        """
+        Removes an interrupted scan and its hosts
+        :return:
+        """
+        ScannedHost.objects(scan_id=self.scan_id).delete()
+        self.delete()
+
+    def get_host(self, host):
+        """
+        :param host:
+        :return: the scanned host OR None if it is not part of the scan
+        """
+        return ScannedHost.objects(scan_id=self.scan_id, host=host).first()
+
+    def get_hosts(self, status=None):
+        """
+        :param status: only the hosts with this status
+        :return: queryset of the hosts (read in batches)
+        """
+        hosts = ScannedHost.objects(scan_id=self.scan_id)
+        return hosts.filter(status=status) if status else hosts
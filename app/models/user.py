@@ -5,7 +5,8 @@ from werkzeug.exceptions import NotFound, Forbidden, BadRequest, Conflict, Inter
 
 from app import db
 from mongoengine.errors import NotUniqueError, ValidationError, DoesNotExist, OperationError
-from werkzeug.security import generate_password_hash, check_password_hash
+
+from app.utils.passwords import passwords
 
 
 class Role(Enum):
@@ -35,7 +36,7 @@ class User(db.Document):
     @classmethod
     def get_user(cls, public_id):
         try:
-            user = User.objects.exclude("_id", "password", "old_passwords").get(public_id=public_id)
+            user = User.objects.exclude("id", "password", "old_passwords").get(public_id=public_id)
         except DoesNotExist:
             raise NotFound('User does not exist')
         return user
@@ -43,7 +44,7 @@ class User(db.Document):
     @classmethod
     def get_users(cls):
         try:
-            users = cls.objects.all().exclude("_id", "password", "old_passwords")
+            users = cls.objects.all().exclude("id", "password", "old_passwords")
             return users
         except OperationError:
             raise InternalServerError
@@ -61,11 +62,12 @@ class User(db.Document):
 
     @classmethod
     def update_user(cls, public_id, data):
-
-        try:
-            user = cls.objects.get(public_id=public_id)
-        except DoesNotExist:
-            raise NotFound('User not found')
+        """
+        Updates the user in a single query
+        :param public_id:
+        :param data: fields to update, the others are left unchanged
+        :return: updated user data
+        """
 
         # Exclude password from update_data
         if 'password' in data:
@@ -73,7 +75,8 @@ class User(db.Document):
 
         # Update the user data
         try:
-            user.update(**data)
+            users = cls.objects(public_id=public_id).exclude("id", "password", "old_passwords")
+            user = users.modify(new=True, **data) if data else users.first()
         except NotUniqueError as e:
             raise BadRequest('Email already in use ')
         except ValidationError as e:
@@ -81,8 +84,20 @@ class User(db.Document):
         except OperationError as e:
             raise InternalServerError(str(e))
 
+        if user is None:
+            raise NotFound('User not found')
+
         return user.to_dict()
 
+    @classmethod
+    def update_password_hash(cls, public_id, old_hash, new_hash):
+        """
+        Replaces the hash of an unchanged password (rehash with the current method)
+        :param old_hash: hash the new one was computed from, nothing is done if the password changed meanwhile
+        :return: True if the hash was replaced
+        """
+        return bool(cls.objects(public_id=public_id, password=old_hash).update_one(set__password=new_hash))
+
     @classmethod
     def delete_user(cls, public_id):
         try:
@@ -105,4 +120,4 @@ class User(db.Document):
         return user_dict
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return passwords.check(self.password, password)
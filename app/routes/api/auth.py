@@ -1,19 +1,22 @@
 from datetime import datetime, timedelta, timezone
 
 from flask import Blueprint, request, redirect, url_for, jsonify, render_template
-from flask_jwt_extended import create_access_token, jwt_required, unset_jwt_cookies, get_jwt, decode_token
+from flask_jwt_extended import create_access_token, unset_jwt_cookies, decode_token
 from mongoengine import DoesNotExist
-from werkzeug.exceptions import BadRequest, Unauthorized
+from werkzeug.exceptions import BadRequest, Unauthorized, ServiceUnavailable
 
 from app.models.registration_requests import RegistrationRequest
 from app.utils.mail import send_email
 from app.models.revoked_tokens import RevokedToken
 from app.models.user import User
-from werkzeug.security import generate_password_hash, check_password_hash
+from app.utils.revocation_cache import revocation_cache
+from app.utils.passwords import passwords
 
 
 
-from app.routes.api.middleware import confirm_email_token, generate_email_token, is_talan_email, is_strong_password
+from app.routes.api.middleware import confirm_email_token, generate_email_token, is_talan_email, is_strong_password, \
+    identity_required
+from app.utils.identity import get_identity
 
 ####### Vaariables ########
 auth = Blueprint('auth', __name__)
@@ -42,7 +45,13 @@ def login():
     # Change return to 'incorrect credentials' only
     try:
         user = User.objects(email=email).first()
-        if user and check_password_hash(user.password, password):
+        if user and passwords.check(user.password, password):
+            if passwords.needs_rehash(user.password):
+                # hashed with older parameters, replaced in the background
+                public_id, old_hash = user.public_id, user.password
+                passwords.rehash_later(password,
+                                       lambda new_hash: User.update_password_hash(public_id, old_hash, new_hash))
+
             # access token creation, to include more information in token, add it to user_data dictionary
             roles = [role.value for role in user.roles]
             claims = {'roles': roles}
@@ -64,21 +73,27 @@ def login():
             return jsonify(message='Incorrect credentials'), 401
     except DoesNotExist as e:
         return jsonify({'error': e.message})
+    except ServiceUnavailable as e:
+        return jsonify(message=e.description), e.code
 
 
 
 # Logout route
 @auth.route('/logout', methods=['POST'])
-@jwt_required()
+@identity_required
 def logout():
     """
     Logs out a user by adding their token to revoked tokens
     :return: 200 logout success OR 400 error
     """
     try:
-        jti = get_jwt()["jti"]
-        issued_at = datetime.fromtimestamp(get_jwt()["iat"], tz=timezone.utc)  # Convert iat to datetime in utc timezone (local time by default)
-        RevokedToken.revoke_token(jti=jti, issued_at=issued_at, expired_at=datetime.utcnow())
+        claims = get_identity().claims
+        jti = claims["jti"]
+        issued_at = datetime.fromtimestamp(claims["iat"], tz=timezone.utc)  # Convert iat to datetime in utc timezone (local time by default)
+        # the token stays revoked until it expires by itself
+        expired_at = datetime.utcfromtimestamp(claims["exp"])
+        RevokedToken.revoke_token(jti=jti, issued_at=issued_at, expired_at=expired_at)
+        revocation_cache.add(jti, expired_at)
         return jsonify({"message": "Logout successful"}), 200
     except BadRequest as e:
         return jsonify({'error': str(e)}), e.code
@@ -136,7 +151,10 @@ def reset_password(token):
 
     user = User.objects(email=email).first()
     if user:
-        user.password = generate_password_hash(password1)
+        try:
+            user.password = passwords.hash(password1)
+        except ServiceUnavailable as e:
+            return jsonify(message=e.description), e.code
         user.save()
         return jsonify({"message": "Password updated"}), 200
     else:
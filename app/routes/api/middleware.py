@@ -1,10 +1,11 @@
 import re
 
-from flask_jwt_extended import jwt_required, create_access_token, verify_jwt_in_request, get_jwt
+from flask_jwt_extended import jwt_required, create_access_token, verify_jwt_in_request
 from functools import wraps
 
 import config
 from app.models.user import Role
+from app.utils.identity import get_identity, get_identity_error
 
 # from app import app
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
@@ -94,6 +95,26 @@ def confirm_email_token(token):
         return False
 
 
+# AUTHENTICATION REQUIRED DECORATOR
+def identity_required(f):
+    """
+    Decorator function that checks that the request carries a valid token,
+    reads the identity stored by the before_request middleware (the token is not decoded again)
+    :param f:
+    :return:
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if get_identity() is None:
+            # expired, malformed or revoked token, OR no token at all
+            message, code = get_identity_error() or ('Missing token', 401)
+            return {'message': message}, code
+
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
 # ADMIN REQUIRED DECORATOR
 def admin_required(f):
     """
@@ -104,20 +125,16 @@ def admin_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
 
-        # verifies if token is valid (can replace token required
-        #verify_jwt_in_request()
-
         # Check if token has required claims
-        claims = get_jwt()['claims']
-        if not claims or 'roles' not in claims:
+        identity = get_identity()
+        if identity is None or identity.roles is None:
             return {'message': 'Invalid token'}, 401
 
         # Check that the "admin" role is present in the list of roles
-        roles = claims['roles']
-        if Role.ADMIN.value not in roles:
+        if not identity.is_admin:
             return {'message': 'Admin role required'}, 403
 
-        if any(role != Role.ADMIN.value for role in roles):
+        if not identity.has_valid_roles:
             return {'message': 'Invalid token (roles)'}, 400
 
 
@@ -131,18 +148,14 @@ def admin_required(f):
 def team_leader_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        # verifies if token is valid (can replace token required
-        #verify_jwt_in_request()
-
 
         # Check if token has required claims
-        claims = get_jwt()['claims']
-        if not claims or 'roles' not in claims:
+        identity = get_identity()
+        if identity is None or identity.roles is None:
             return {'message': 'Invalid token'}, 401
 
-        # Check that the "admin" role is present in the list of roles
-        roles = claims['roles']
-        if Role.TEAM_LEADER.value not in roles:
+        # Check that the "team leader" role is present in the list of roles
+        if not identity.has_role(Role.TEAM_LEADER):
             return {'message': 'Team Leader role required'}, 403
 
         # Call the wrapped function if all checks pass
@@ -1,13 +1,12 @@
 from flask import Blueprint, jsonify, request
 
-from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
 from mongoengine import ValidationError
 from werkzeug.exceptions import Forbidden, BadRequest, NotFound, abort, InternalServerError
 
-from app.models.user import Role
 from app.models.user import User
 
-from .middleware import admin_required, team_leader_required
+from .middleware import admin_required, team_leader_required, identity_required
+from app.utils.identity import get_identity
 from app.models.mission import Mission
 
 # Define blueprints
@@ -20,7 +19,7 @@ ELSE => GET MY MISSIONS
 
 
 @missions.route('/<string:mission_id>', methods=['GET'])
-@jwt_required()
+@identity_required
 def get_mission(mission_id):
     """
 
@@ -28,20 +27,18 @@ def get_mission(mission_id):
     :return:
     """
 
-    token_public_id = get_jwt_identity()
+    identity = get_identity()
+    if identity.roles is None:
+        return jsonify(message="Invalid token"), 401
     try:
         # Check that the "admin" role is present in the list of roles
-        claims = get_jwt()['claims']
-        roles = claims['roles']
-        if Role.ADMIN.value in roles:
-            if any(role != Role.ADMIN.value for role in roles):
+        if identity.is_admin:
+            if not identity.has_valid_roles:
                 return {'message': 'Invalid token (roles)'}, 400
 
             mission_data = Mission.get_mission()
         else:
-            mission_data = Mission.get_mission(member_id=token_public_id)
-    except KeyError:
-        return jsonify(message="Invalid token"), 401
+            mission_data = Mission.get_mission(member_id=identity.public_id)
     except InternalServerError as e:
         return jsonify(message="Something went wrong"), e.code
 
@@ -49,27 +46,25 @@ def get_mission(mission_id):
 
 
 @missions.route('/', methods=['GET'])
-@jwt_required()
+@identity_required
 def get_missions():
     """
 
     :return:
     """
 
-    token_public_id = get_jwt_identity()
+    identity = get_identity()
+    if identity.roles is None:
+        return jsonify(message="Invalid token"), 401
     try:
         # Check that the "admin" role is present in the list of roles
-        claims = get_jwt()['claims']
-        roles = claims['roles']
-        if Role.ADMIN.value in roles:
-            if any(role != Role.ADMIN.value for role in roles):
+        if identity.is_admin:
+            if not identity.has_valid_roles:
                 return {'message': 'Invalid token (roles)'}, 400
 
             missions_list = Mission.get_missions_overview()
         else:
-            missions_list = Mission.get_missions_overview(member_id=token_public_id)
-    except KeyError:
-        return jsonify(message="Invalid token"), 401
+            missions_list = Mission.get_missions_overview(member_id=identity.public_id)
     except InternalServerError as e:
         return jsonify(message="Something went wrong"), e.code
     except Forbidden as e:  # raised in get_missions_overview()
@@ -82,14 +77,14 @@ def get_missions():
 
 @missions.route('/add', methods=['POST'])
 @team_leader_required
-@jwt_required()
+@identity_required
 def add_mission():
     """
 
     :return:
     """
 
-    team_leader = get_jwt_identity()
+    team_leader = get_identity().public_id
     data = request.get_json()
     if not data['team_leader']:
         data['team_leader'] = team_leader
@@ -108,7 +103,7 @@ def add_mission():
 
 @missions.route('/<string:mission_id>/assign_members', methods=['PUT'])
 @team_leader_required
-@jwt_required()
+@identity_required
 def assign_members(mission_id):
     """
 
@@ -132,7 +127,7 @@ def assign_members(mission_id):
 
 @missions.route('/<string:mission_id>/assign_members', methods=['PUT'])
 @team_leader_required
-@jwt_required()
+@identity_required
 def remove_members(mission_id):
     """
 
@@ -156,7 +151,7 @@ def remove_members(mission_id):
 
 @missions.route('/<string:mission_id>/delete', methods=['DELETE'])
 @team_leader_required
-@jwt_required()
+@identity_required
 def delete_mission(mission_id):
     """
 
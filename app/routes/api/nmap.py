@@ -1,19 +1,44 @@
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required
-from werkzeug.exceptions import InternalServerError, BadRequest
+from werkzeug.exceptions import InternalServerError, BadRequest, NotFound, ServiceUnavailable
 
-from app.tools.nmap_scanner import run_nmap_scan, host_discovery
+from app.models.mission import Mission
+from app.tools.nmap_scanner import iter_nmap_scan, host_discovery, iter_host_discovery, check_targets
+from app.utils.identity import get_identity
+from app.utils.scan_jobs import scan_jobs
+from app.utils.streaming import get_stream_mode, stream_response
+from .middleware import identity_required
 
 # Define blueprints
 nmap = Blueprint('nmap', __name__)
 
 
+def stream_scan(hosts, stream_mode):
+    """
+    Streams a scan running in the request, within the limits of the scan jobs (workers + queue_size)
+    :param hosts: generator of the scan results
+    :param stream_mode: 'sse' or 'ndjson'
+    :return: streamed response
+    :raise ServiceUnavailable: too many scans running or waiting
+    """
+    release = scan_jobs.reserve()
+    try:
+        response = stream_response(hosts, stream_mode)
+    except Exception:
+        release()
+        raise
+    # called by the server once the response is over, even if the client left before the first host
+    response.call_on_close(release)
+    return response
+
+
 @nmap.route('/run_scan', methods=['POST'], endpoint='nmap_scan')
-@jwt_required
+@identity_required
 def run_scan():
     """
-
-    :return:
+    Queues an Nmap scan, results are fetched through the jobs endpoints.
+    With 'stream': 'sse' | 'ndjson' (or the matching Accept header) the scan runs right away
+    and each host is sent as soon as nmap finishes it
+    :return: 202 job id OR 200 stream of hosts OR 400, 503 error
     """
 
     try:
@@ -29,32 +54,111 @@ def run_scan():
         options = data.get('options', None)
         ports = data.get('ports', None)
         scripts = data.get('scripts', None)
+        # ignore cached results of a previous identical scan
+        force_refresh = bool(data.get('force_refresh', False))
+        # store the scan with the mission, incremental: only rescan hosts that changed since the last scan
+        mission_id = data.get('mission_id', None)
+        incremental = bool(data.get('incremental', False))
+
+        # invalid or too large target sets are refused before anything is queued
+        check_targets(targets)
+
+        if incremental and not mission_id:
+            raise BadRequest('"incremental" scans require a "mission_id"')
+        if mission_id and not Mission.objects(mission_id=mission_id).first():
+            raise NotFound('Mission not found')
+
+        scan_args = (targets, scan_type, options, ports, scripts, force_refresh, mission_id, incremental)
 
-        # Run the Nmap scan
-        scan_results = run_nmap_scan(targets, scan_type, options, ports, scripts)
+        stream_mode = get_stream_mode(request, data)
+        if stream_mode:
+            return stream_scan(iter_nmap_scan(*scan_args), stream_mode)
 
-        return jsonify({"results": scan_results}), 200
+        # Queue the Nmap scan
+        job = scan_jobs.submit('nmap', get_identity().public_id, iter_nmap_scan, *scan_args)
+
+        return jsonify(job_id=job.job_id, status=job.status), 202
     except KeyError:
         return jsonify(error="Missing or incorrect fields"), 400
-    except BadRequest as e:
+    except (BadRequest, NotFound, ServiceUnavailable) as e:
         return jsonify({"error": str(e)}), e.code
     except Exception as e:
         return jsonify({"error": "An internal server error occurred"}), 500
 
 
+@nmap.route('/jobs/<string:job_id>', methods=['GET'])
+@identity_required
+def get_job(job_id):
+    """
+    Polls the status of a scan job
+    :param job_id:
+    :return: 200 job status OR 404
+    """
+    try:
+        job = scan_jobs.get(job_id, get_identity().public_id)
+    except NotFound as e:
+        return jsonify({"error": str(e)}), e.code
+
+    return jsonify(job=job.to_dict()), 200
+
+
+@nmap.route('/jobs/<string:job_id>/results', methods=['GET'])
+@identity_required
+def get_job_results(job_id):
+    """
+    Returns partial (while running) or final results of a scan job,
+    'offset' query parameter allows fetching only the hosts not yet received
+    :param job_id:
+    :return: 200 job status and results OR 400, 404
+    """
+    try:
+        offset = request.args.get('offset', 0, type=int)
+        if offset < 0:
+            raise BadRequest('Invalid offset')
+        job, results = scan_jobs.get_results(job_id, get_identity().public_id, offset)
+    except (NotFound, BadRequest) as e:
+        return jsonify({"error": str(e)}), e.code
+
+    return jsonify(job=job.to_dict(), offset=offset, results=results), 200
+
+
+@nmap.route('/jobs/<string:job_id>/cancel', methods=['POST'])
+@identity_required
+def cancel_job(job_id):
+    """
+    Cancels a queued or running scan job
+    :param job_id:
+    :return: 200 job status OR 404
+    """
+    try:
+        job = scan_jobs.cancel(job_id, get_identity().public_id)
+    except NotFound as e:
+        return jsonify({"error": str(e)}), e.code
+
+    return jsonify(job=job.to_dict()), 200
+
+
 @nmap.route('/discover-hosts', methods=['POST'])
-@jwt_required
+@identity_required
 def discover_hosts():
     try:
-        subnet = request.json.get('subnet')
+        subnet = request.json['subnet']
+        force_refresh = bool(request.json.get('force_refresh', False))
+        check_targets(subnet)
+
+        stream_mode = get_stream_mode(request, request.json)
+        if stream_mode:
+            return stream_scan(iter_host_discovery(subnet, force_refresh), stream_mode)
 
         # Perform host discovery using the host_discovery function
-        discovered_hosts = host_discovery(subnet)
+        discovered_hosts = host_discovery(subnet, force_refresh)
 
         return jsonify({"discovered_hosts": discovered_hosts}), 200
 
     except KeyError as e:
         return jsonify({"error": "Missing 'subnet' field in request data"}), 400
+    except (BadRequest, ServiceUnavailable) as e:
+        return jsonify({"error": str(e)}), e.code
     except InternalServerError as e:
         return jsonify({"error": "Unable to run host discovery"}), e.code
     except Exception as e:
@@ -0,0 +1,33 @@
+from flask import Blueprint, jsonify
+
+from app.utils.connection_pool import pool
+from .middleware import admin_required, identity_required
+
+# Define blueprints
+nodes = Blueprint('nodes', __name__)
+
+
+@nodes.route('/utilization', methods=['GET'])
+@identity_required
+@admin_required
+def get_utilization():
+    """
+    Leases, transports and load of every pool node, to check that the tool runs are spread over the nodes
+    :return: 200 utilization of the nodes
+    """
+    return jsonify(pool.utilization()), 200
+
+
+@nodes.route('/reload', methods=['POST'])
+@identity_required
+@admin_required
+def reload_nodes():
+    """
+    Applies the changes of the nodes collection to the pool right away (new nodes are prewarmed,
+    removed nodes are drained), without waiting for the periodic reload
+    :return: 200 utilization of the nodes OR 500 error
+    """
+    if not pool.load_nodes():
+        return jsonify(message='Unable to load the nodes'), 500
+    pool.prewarm()
+    return jsonify(pool.utilization()), 200
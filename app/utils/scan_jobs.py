@@ -0,0 +1,246 @@
+"""
+    Background job engine for long running tool scans
+
+    The state of the jobs is kept in mongodb (models/scan_jobs) so that any worker process answers
+    for a job queued on another one, jobs are only visible to the user who submitted them.
+
+    Job={
+        'job_id': uuid,
+        'status': 'queued' | 'running' | 'completed' | 'failed' | 'cancelled',
+        'results_count': int,  # results are stored host by host while the job is running
+    }
+
+    The worker refreshes the heartbeat of its jobs, the jobs of a stopped worker are marked failed
+    at startup and when they are polled.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+
+from app.models.scan_jobs import ScanJobRecord, ScanJobResult
+
+
+class ScanJob:
+    """
+    Job running (or queued) in this worker process
+    """
+    def __init__(self, name):
+        self.job_id = str(uuid.uuid4())
+        self.name = name
+        self.status = 'queued'
+        self.future = None
+        self.cancel_event = threading.Event()
+
+
+class ScanJobManager:
+    def __init__(self, workers=4, queue_size=16, retention=timedelta(hours=1), heartbeat=30,
+                 stale_after=timedelta(minutes=5)):
+        """
+
+        :param workers: number of scans running at the same time
+        :param queue_size: number of scans allowed to wait for a free worker
+        :param retention: time a finished job is kept before being dropped
+        :param heartbeat: seconds between two heartbeats of the jobs of this worker
+        :param stale_after: jobs without heartbeat for this time are marked failed
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retention = retention
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.heartbeat_thread = None
+        # jobs of this process not finished yet
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.slots = None
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def init_app(self, app):
+        self.workers = app.config.get('SCAN_JOB_WORKERS', self.workers)
+        self.queue_size = app.config.get('SCAN_JOB_QUEUE_SIZE', self.queue_size)
+        self.retention = app.config.get('SCAN_JOB_RETENTION', self.retention)
+        self.heartbeat = app.config.get('SCAN_JOB_HEARTBEAT', self.heartbeat)
+        self.stale_after = app.config.get('SCAN_JOB_STALE_AFTER', self.stale_after)
+        self._start()
+
+        # jobs left queued or running by a worker that stopped (crash, restart)
+        try:
+            ScanJobRecord.fail_stale_jobs(self.stale_after, self.retention)
+        except Exception as e:
+            print(f'Unable to check the stale scan jobs: {e}')
+
+    def _start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scan-job')
+        # running + waiting jobs can never exceed this number
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        # the executor threads are not inherited by forked worker processes
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self._start_heartbeat()
+
+    def _start_heartbeat(self):
+        self.heartbeat_thread = threading.Thread(target=self._beat, name='scan-job-heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self.lock:
+                job_ids = list(self.jobs)
+            if not job_ids:
+                continue
+            try:
+                ScanJobRecord.beat(job_ids)
+            except Exception as e:
+                print(f'Unable to refresh the heartbeat of the scan jobs: {e}')
+
+    def submit(self, name, owner, func, *args, **kwargs):
+        """
+        Queues a scan, func must return an iterable of results (one item per host)
+
+        :param name: name of the job (tool name)
+        :param owner: public_id of the user submitting the job
+        :param func: function running the scan
+        :return: the created job
+        """
+        if not self.executor:
+            self._start()
+        elif not self.heartbeat_thread.is_alive():
+            # forked worker process
+            self._start_heartbeat()
+
+        if not self.slots.acquire(blocking=False):
+            raise ServiceUnavailable('Scan queue is full, try again later')
+
+        job = ScanJob(name)
+        try:
+            ScanJobRecord.create_job(job.job_id, name, owner, self.worker)
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.jobs[job.job_id] = job
+
+        try:
+            job.future = self.executor.submit(self._run, job, func, args, kwargs)
+        except RuntimeError:
+            self.slots.release()
+            self._finish(job, 'failed', 'Scan workers are shutting down')
+            raise ServiceUnavailable('Scan workers are shutting down')
+
+        job.future.add_done_callback(lambda future: self.slots.release())
+        return job
+
+    def reserve(self):
+        """
+        Takes a slot for a scan running outside of the queue (streamed to the client),
+        streamed and queued scans share the workers + queue_size limit
+        :return: function releasing the slot, to call once the scan is over
+        :raise ServiceUnavailable: no free slot
+        """
+        if not self.executor:
+            self._start()
+
+        if not self.slots.acquire(blocking=False):
+            raise ServiceUnavailable('Scan queue is full, try again later')
+
+        released = threading.Event()
+
+        def release():
+            if not released.is_set():
+                released.set()
+                self.slots.release()
+
+        return release
+
+    def get(self, job_id, owner):
+        """
+        :param job_id:
+        :param owner: public_id of the user asking
+        :return: the job
+        :raise NotFound: unknown job, or job of another user
+        """
+        job = ScanJobRecord.get_job(job_id, owner)
+        if not job:
+            raise NotFound('Job not found')
+
+        if not job.done and job.heartbeat_at < datetime.utcnow() - self.stale_after:
+            # the worker running the job stopped
+            ScanJobRecord.fail_stale_jobs(self.stale_after, self.retention, job_id)
+            job.reload()
+        return job
+
+    def get_results(self, job_id, owner, offset=0):
+        """
+        :param offset: number of results already received
+        :return: (job, results from offset)
+        """
+        job = self.get(job_id, owner)
+        return job, ScanJobResult.get_results(job_id, offset)
+
+    def cancel(self, job_id, owner):
+        """
+        Cancels a queued job right away, a running job stops after the host being processed
+        (whatever the worker process running it)
+        :param job_id:
+        :param owner: public_id of the user asking
+        :return: the job
+        """
+        job = ScanJobRecord.cancel_job(job_id, owner, self.retention)
+        if not job:
+            raise NotFound('Job not found')
+
+        local = self.jobs.get(job_id)
+        if local:
+            local.cancel_event.set()
+            if local.future and local.future.cancel():
+                self._finish(local, 'cancelled')
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        if job.cancel_event.is_set() or not ScanJobRecord.start_job(job.job_id):
+            # cancelled while queued
+            with self.lock:
+                self.jobs.pop(job.job_id, None)
+            return
+
+        job.status = 'running'
+        results = None
+        error = None
+        try:
+            results = iter(func(*args, **kwargs))
+            for result in results:
+                if ScanJobRecord.add_result(job.job_id, result):
+                    job.cancel_event.set()
+                if job.cancel_event.is_set():
+                    break
+            status = 'cancelled' if job.cancel_event.is_set() else 'completed'
+        except Exception as e:
+            status = 'failed'
+            error = getattr(e, 'description', None) or str(e)
+        finally:
+            # closing the generator stops the underlying scan
+            close = getattr(results, 'close', None)
+            if close:
+                close()
+        self._finish(job, status, error)
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        with self.lock:
+            self.jobs.pop(job.job_id, None)
+        try:
+            ScanJobRecord.finish_job(job.job_id, status, error, self.retention)
+        except Exception as e:
+            print(f'Unable to save the state of scan job {job.job_id}: {e}')
+
+
+##### Creation of job manager ( initialized in __init__ ) #####
+scan_jobs = ScanJobManager()
@@ -1,11 +1,26 @@
+import codecs
+import select
+import time
 from enum import Enum
 
 from paramiko import RSAKey, SSHClient, AutoAddPolicy, SSHException
 
 
+class CommandFailed(Exception):
+    """
+    Raised when a streamed command exits with a non zero status (the connection itself is fine)
+    """
+
+    def __init__(self, command, exit_status, stderr=''):
+        self.command = command
+        self.exit_status = exit_status
+        self.stderr = stderr
+        super().__init__(f'command exited with status {exit_status}: {stderr.strip()[-500:]}')
+
+
 class SSHConnection(SSHClient):
 
-    def __init__(self, hostname, username=None, password=None, pkfile=None, port=22):
+    def __init__(self, hostname, username=None, password=None, pkfile=None, port=22, timeout=None):
         """
 
         :param hostname:
@@ -13,7 +28,9 @@ class SSHConnection(SSHClient):
         :param password:
         :param pkfile:
         :param port:
+        :param timeout: seconds to wait for the TCP connection and the ssh banner (None: system default)
         """
+        self.hostname = hostname
         try:
 
             SSHClient.__init__(self)
@@ -21,10 +38,10 @@ class SSHConnection(SSHClient):
 
             if username and password:
                 self.connect(hostname, username=username,
-                             password=password, port=port)
+                             password=password, port=port, timeout=timeout, banner_timeout=timeout)
             elif pkfile:
                 k = RSAKey.from_private_key_file(pkfile, password='testest')
-                self.connect(hostname, username=username, pkey=k)
+                self.connect(hostname, username=username, pkey=k, timeout=timeout, banner_timeout=timeout)
 
             else:
                 raise SSHException
@@ -34,46 +51,151 @@ class SSHConnection(SSHClient):
             print("Error connecting to %s: %s" % (hostname, e))
             raise SSHException
 
-        self.status = 'available'
+    def is_active(self):
+        """
+        :return: True while the transport is connected, its channels can still be used
+        """
+        transport = self.get_transport()
+        return transport is not None and transport.is_active()
 
-    def run_command(self, command):
+    def probe(self, timeout=5):
         """
-        Running command and returning the stdout to the invoker
+        Checks that the node still answers by opening (and closing) a channel,
+        an unresponsive transport is closed
+        :param timeout: seconds to wait for the node
+        :return: True if the connection works
+        """
+        try:
+            self.get_transport().open_session(timeout=timeout).close()
+            return True
+        except (SSHException, OSError, AttributeError):
+            self.close()
+            return False
+
+    def stream_command(self, command, chunk_size=32768, timeout=None, cancel=None):
+        """
+        Runs a command and yields its output as it arrives, nothing is read before the invoker asks for it:
+        when the invoker is slower than the command, the ssh window fills and the remote command waits (backpressure)
+
         :param command:
-        :return:
+        :param chunk_size: maximum size of the yielded chunks
+        :param timeout: seconds the whole command may take
+        :param cancel: event, the channel is closed as soon as it is set (the generator stops without exit status)
+        :return: generator of ('stdout', bytes), ('stderr', bytes) and finally ('exit', exit status)
+        :raise SSHException: the connection was lost before the command exited
         """
+        deadline = time.monotonic() + timeout if timeout else None
 
-        # make status busy
-        self.status = "busy"
+        channel = None
         try:
-            stdin, stdout, stderr = self.exec_command(command)
-            # just for test
-            print(type(stdin))
-            print(type(stdout))
-            print(type(stderr))
+            channel = self.get_transport().open_session()
+            channel.exec_command(command)
+
+            while True:
+                if cancel is not None and cancel.is_set():
+                    # the channel is closed below, the remote command gets no more input and output
+                    return
+
+                received = False
+                if channel.recv_ready():
+                    received = True
+                    yield 'stdout', channel.recv(chunk_size)
+                if channel.recv_stderr_ready():
+                    received = True
+                    yield 'stderr', channel.recv_stderr(chunk_size)
+                if received:
+                    continue
+
+                if channel.exit_status_ready() and channel.eof_received:
+                    break
+                if channel.closed:
+                    break
+                if deadline and time.monotonic() > deadline:
+                    raise TimeoutError(f'{command} timed out after {timeout} seconds')
+
+                # waits for data without busy looping
+                select.select([channel], [], [], 0.1)
+
+            # a dropped transport closes the channel with the exit status -1, it is a connection error
+            # (the command may be fine on another connection), not a failed command
+            if not channel.exit_status_ready() or (channel.recv_exit_status() == -1 and not self.is_active()):
+                raise SSHException(f'Connection to {self.hostname} lost while running {command}')
+
+            yield 'exit', channel.recv_exit_status()
+        finally:
+            if channel is not None:
+                channel.close()
 
-            if stdout.channel.recv_exit_status() == 0:
+    def iter_output(self, command, chunk_size=32768, timeout=None, max_stderr=65536, cancel=None):
+        """
+        Yields the stdout of a command chunk by chunk
 
-                print(f'STDOUT: {stdout.read().decode("utf8")}')
-                output = stdout.read().decode("utf8")
+        :param command:
+        :param chunk_size:
+        :param timeout: seconds the whole command may take
+        :param max_stderr: bytes of stderr kept for the error message
+        :param cancel: event stopping the command (see stream_command)
+        :return: generator of bytes
+        :raise CommandFailed: when the command exits with a non zero status
+        :raise SSHException: the connection was lost before the command exited
+        """
+        stderr = b''
+        for stream, data in self.stream_command(command, chunk_size, timeout, cancel):
+            if stream == 'stdout':
+                yield data
+            elif stream == 'stderr':
+                stderr = (stderr + data)[-max_stderr:]
+            elif data != 0:
+                raise CommandFailed(command, data, stderr.decode('utf8', errors='replace'))
+
+    def iter_lines(self, command, timeout=None):
+        """
+        Yields the stdout of a command line by line (decoded), as soon as each line is complete
 
-            else:
-                print(f'STDERR: {stderr.read().decode("utf8")}')
-                output = False
+        :param command:
+        :param timeout: seconds the whole command may take
+        :return: generator of str
+        :raise CommandFailed: when the command exits with a non zero status
+        """
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        pending = ''
+        for chunk in self.iter_output(command, timeout=timeout):
+            pending += decoder.decode(chunk)
+            *lines, pending = pending.split('\n')
+            yield from lines
+
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending
+
+    def run_command(self, command, max_output=None, timeout=None):
+        """
+        Running command and returning the stdout to the invoker
 
-            # CLOSING STD FILE OBJECTS
-            stdin.close()
-            stdout.close()
-            stderr.close()
+        :param command:
+        :param max_output: bytes of stdout kept, the rest is read and dropped
+        :param timeout: seconds the whole command may take
+        :return: stdout OR False if the command failed
+        """
+        output = bytearray()
+        truncated = False
+        try:
+            for chunk in self.iter_output(command, timeout=timeout):
+                if max_output is not None and len(output) + len(chunk) > max_output:
+                    chunk = chunk[:max_output - len(output)]
+                    truncated = True
+                output += chunk
+        except CommandFailed as e:
+            print(f'STDERR: {e.stderr}')
+            return False
         except SSHException:
             print('it went wrong')
             raise SSHException
 
-        finally:
-            # change back to available
-            self.status = "available"
+        if truncated:
+            print(f'Output of {command} truncated to {max_output} bytes')
 
-        return output
+        return output.decode("utf8", errors="replace")
 
     def __del__(self):
         """
@@ -0,0 +1,71 @@
+import json
+
+from flask import Response, stream_with_context
+
+stream_mimetypes = {
+    'sse': 'text/event-stream',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def get_stream_mode(request, data=None):
+    """
+    Finds the streaming mode asked by the client, from the 'stream' field/query parameter or the Accept header
+    :param request: flask request
+    :param data: json body of the request
+    :return: 'sse', 'ndjson' OR None (no streaming)
+    """
+    mode = (data or {}).get('stream') or request.args.get('stream')
+    if mode in stream_mimetypes:
+        return mode
+
+    accepted = request.accept_mimetypes
+    for mode, mimetype in stream_mimetypes.items():
+        if accepted.best == mimetype:
+            return mode
+
+    return None
+
+
+def stream_response(records, mode, event='host'):
+    """
+    Sends the records to the client one by one as soon as they are produced,
+    nothing is accumulated on the server side
+
+    SSE: 'event: host' for each record, then 'event: done' ( or 'event: error' )
+    NDJSON: one {"host": ...} json document per line, then {"done": {"count": }} ( or {"error": ...} )
+
+    :param records: iterable of json serializable records
+    :param mode: 'sse' or 'ndjson'
+    :param event: name of the SSE event / key of the NDJSON records
+    :return: streamed flask response
+    """
+
+    def format_record(name, payload):
+        if mode == 'sse':
+            return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
+        return json.dumps({name: payload}) + '\n'
+
+    def generate():
+        count = 0
+        try:
+            for record in records:
+                count += 1
+                yield format_record(event, record)
+        except Exception as e:
+            yield format_record('error', getattr(e, 'description', None) or 'An internal server error occurred')
+            return
+        finally:
+            # stops the underlying scan when the client disconnects
+            close = getattr(records, 'close', None)
+            if close:
+                close()
+
+        yield format_record('done', {'count': count})
+
+    headers = {
+        'Cache-Control': 'no-cache',
+        # disables response buffering on nginx
+        'X-Accel-Buffering': 'no',
+    }
+    return Response(stream_with_context(generate()), mimetype=stream_mimetypes[mode], headers=headers)
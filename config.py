@@ -37,6 +37,118 @@ class Config(object):
 
     UPLOADS = ''
 
+    #REVOKED TOKENS
+    # revoked tokens are checked in memory: bloom filter sized for REVOKED_TOKENS_CAPACITY tokens, LRU of the
+    # database answers, tokens revoked by the other workers fetched every REVOKED_TOKENS_SYNC_INTERVAL seconds
+    REVOKED_TOKENS_CAPACITY = 100000
+    REVOKED_TOKENS_ERROR_RATE = 0.001
+    REVOKED_TOKENS_LRU_SIZE = 10000
+    REVOKED_TOKENS_SYNC_INTERVAL = 5
+    REVOKED_TOKENS_REBUILD_INTERVAL = 3600
+
+    #PASSWORDS
+    # passwords are hashed by PASSWORD_HASH_WORKERS dedicated threads (cores used by a login burst),
+    # up to PASSWORD_HASH_QUEUE_SIZE more logins wait for them, the next ones get a 503
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_SIZE = 32
+    # werkzeug method ( 'pbkdf2:sha256:600000' is the werkzeug default, 'scrypt', 'scrypt:65536:8:1' ... ),
+    # hashes made with another method are replaced on the next login: changing it migrates every password
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_SALT_LENGTH = 16
+    # seconds a request waits for its hash
+    PASSWORD_HASH_TIMEOUT = 30
+
+    #SCAN JOBS
+    # number of scans running at the same time, and number of scans allowed to wait for a free worker
+    SCAN_JOB_WORKERS = 4
+    SCAN_JOB_QUEUE_SIZE = 16
+    # finished jobs (and their results) are dropped after this delay
+    SCAN_JOB_RETENTION = timedelta(hours=1)
+    # running workers refresh the heartbeat of their jobs this often (seconds), jobs without heartbeat
+    # for SCAN_JOB_STALE_AFTER belong to a stopped worker and are marked failed
+    SCAN_JOB_HEARTBEAT = 30
+    SCAN_JOB_STALE_AFTER = timedelta(minutes=5)
+
+    #SSH CONNECTIONS POOL
+    # commands running at the same time per node (when max_conns is not set on the node),
+    # and seconds to wait for a free one
+    SSH_CONNS_PER_NODE = 10
+    SSH_ACQUIRE_TIMEOUT = 30
+    # commands run in exec channels multiplexed over a few authenticated transports per node,
+    # keep SSH_CHANNELS_PER_TRANSPORT under the MaxSessions of the nodes sshd (10 by default)
+    SSH_TRANSPORTS_PER_NODE = 2
+    SSH_CHANNELS_PER_TRANSPORT = 8
+    # health of the transports (seconds): keepalive packets, probe before leasing a transport idle for
+    # SSH_PROBE_IDLE, idle and lifetime limits, background checks every SSH_HEALTH_INTERVAL (0 disables them)
+    SSH_KEEPALIVE_INTERVAL = 30
+    SSH_PROBE_IDLE = 60
+    SSH_PROBE_TIMEOUT = 5
+    SSH_MAX_IDLE = 300
+    SSH_MAX_LIFETIME = 3600
+    SSH_HEALTH_INTERVAL = 30
+    # node chosen for a lease: 'least_leases', 'weighted' (by max_conns) or 'load' (/proc/loadavg of the nodes,
+    # read every SSH_HEALTH_INTERVAL)
+    SSH_NODE_SELECTION = 'least_leases'
+    # transports opened per node at startup (in parallel) and kept while idle, 0 opens them on the first lease
+    SSH_PREWARM_TRANSPORTS = 1
+    # seconds between two synchronizations of the pool with the NodesPool collection (0: startup only)
+    SSH_POOL_RELOAD_INTERVAL = 60
+    # failing nodes: seconds to wait for a node to answer, then after SSH_BREAKER_THRESHOLD consecutive failures
+    # the node is not used for SSH_BREAKER_BACKOFF seconds, doubled on each new failure up to SSH_BREAKER_MAX_BACKOFF
+    SSH_CONNECT_TIMEOUT = 10
+    SSH_BREAKER_THRESHOLD = 3
+    SSH_BREAKER_BACKOFF = 5
+    SSH_BREAKER_MAX_BACKOFF = 300
+    # max_conns of the nodes enforced across all the worker processes: None (per process) OR 'mongo' (shared slots,
+    # held for SSH_SLOT_TTL seconds without heartbeat, polled every SSH_SLOT_POLL seconds when all are held)
+    SSH_POOL_COORDINATION = None
+    SSH_SLOT_TTL = 60
+    SSH_SLOT_POLL = 0.5
+    # nodes running the same command at the same time (pool.run_on_nodes)
+    SSH_FANOUT_CONCURRENCY = 16
+
+    #NMAP
+    # large target sets are split in shards of at most NMAP_SHARD_SIZE addresses (power of 2),
+    # scanned by NMAP_SHARD_WORKERS nmap processes at the same time (None: number of cores)
+    NMAP_SHARD_SIZE = 256
+    NMAP_SHARD_WORKERS = None
+    # addresses allowed in a single scan (1048576: an IPv4 /12), larger target sets are refused
+    NMAP_MAX_ADDRESSES = 1048576
+
+    # results of identical scans (same targets and arguments) are reused while fresh,
+    # time to live in seconds per scan type ('ping' is host discovery), 0 disables caching
+    NMAP_CACHE_TTL = {
+        'default': 300,
+        'ping': 120,
+        'udp': 900,
+    }
+    NMAP_CACHE_SIZE = 128
+    NMAP_CACHE_MAX_HOSTS = 4096
+    # also keep cached results in mongodb (shared between workers and restarts)
+    NMAP_CACHE_PERSISTENT = False
+
+    # where nmap runs: 'local', 'remote' (pool nodes having nmap, over ssh) or 'auto' (remote when such nodes exist)
+    NMAP_EXECUTION = 'local'
+    # a shard whose node fails is queued again on another node, up to NMAP_REMOTE_RETRIES times
+    NMAP_REMOTE_RETRIES = 2
+    # seconds a shard waits for a free node connection
+    NMAP_REMOTE_WAIT = 60
+
+    # incremental mission scans scan again hosts whose last scan is older than this
+    NMAP_RESCAN_STALE_AFTER = timedelta(days=1)
+
+    #SQLMAP
+    # sqlmap runs allowed at the same time against the same target host
+    SQLMAP_TARGET_CONCURRENCY = 4
+    # seconds a sqlmap run waits for a free node connection (other runs keep theirs for the whole dump)
+    SQLMAP_ACQUIRE_TIMEOUT = 1800
+    # sqlmap sessions of checkpointed dumps are kept on the nodes under this directory (one per dump)
+    SQLMAP_OUTPUT_DIR = '/tmp/sqlmap-output'
+    # tables of a database dumped by a single sqlmap run (1: one run per table, lowest latency per table)
+    SQLMAP_DUMP_BATCH_SIZE = 5
+    # rows retrieved per table ( --start / --stop )
+    SQLMAP_DUMP_ROWS = 5
+
 
 class ProductionConfig(Config):
     SECRET_KEY = secrets.token_urlsafe(22)